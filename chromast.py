@@ -1,23 +1,22 @@
+import time
+startup_started = time.monotonic() # Före övriga importer så att --profile-startup kan mäta dem
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, font as tkfont
 import os
-import socket
-import threading
-import http.server
-import socketserver
-import pychromecast
-import time
+import sys
+import json
+import argparse
 import logging
-import urllib.parse # För säker URL-hantering och kodning
+import chromast_engine as engine # pychromecast importeras först när motorn startat, se engine.load_cast_stack
+from chromast_engine import PlaylistModel
+from chromast_metrics import traces
+from chromast_transcode import AUDIO_EXTENSIONS
+from chromast_logging import setup_logging
+imports_done = time.monotonic()
+
+PROFILE_STARTUP_TIMEOUT = 30 # Sekunder att vänta på första enheten med --profile-startup
 
-# Loggning - Endast till fil
-logging.basicConfig(
-    level=logging.INFO, # Ändra till logging.DEBUG för mer detaljerad loggning
-    format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s', # Lade till trådnamn
-    handlers=[
-        logging.FileHandler('mp3_to_chromecast.log', encoding='utf-8')
-    ]
-)
+LOG_FILE = 'mp3_to_chromecast.log'
 
 # Hjälptext
 help_text = """
@@ -26,399 +25,455 @@ MP3 till Chromecast – Användarmanual
 Detta program låter dig spela upp MP3-filer från din dator på din Google Chromecast-enhet.
 
 **Steg:**
-1.  **Välj Chromecast:** Vid start söks enheter. Välj din högtalare. Klicka "Uppdatera enheter" vid behov.
-2.  **Lägg till MP3-filer:** Klicka "Lägg till MP3-filer". Första låten spelas automatiskt. Max 100 filer.
-3.  **Spellista:** Dubbelklicka en låt för att spela den. Aktiv låt är blå.
-4.  **Kontroller:**
+1.  **Välj Chromecast:** Senast kända enheter visas direkt vid start och listan uppdateras automatiskt när enheter dyker upp eller försvinner. Välj din högtalare. Klicka "Uppdatera enheter" vid behov. Varje högtalare har en egen spellista och spelar oberoende av de andra; listan väljer vilken högtalare kontrollerna och spellistan gäller.
+2.  **Lägg till ljudfiler:** Klicka "Lägg till ljudfiler". Första låten spelas automatiskt. MP3, FLAC, OGG och AAC spelas direkt; WAV, AIFF och WMA kodas om till MP3 (kräver ffmpeg).
+    **Grupp:** Klicka "Grupp..." och bocka för fler högtalare som ska spela samma låt samtidigt som den valda. Volym, paus och stopp gäller då hela gruppen.
+3.  **Bibliotek:** Klicka "Bibliotek", lägg till dina musikmappar en gång och sök sedan bland låtarna. Nya filer i mapparna läggs till automatiskt.
+4.  **Spellista:** Dubbelklicka en låt för att spela den. Aktiv låt är blå.
+5.  **Kontroller:**
     *   **Volym:** Justera med reglaget.
     *   **Paus/Spela:** Pausa eller återuppta.
     *   **Stopp:** Stoppa uppspelningen.
+    *   **Gapless:** Köar de närmaste låtarna på enheten så att den går vidare utan paus mellan låtarna.
     *   **Rensa spellista:** Tar bort alla låtar.
-5.  **Status:** Visar aktuell aktivitet.
-6.  **Nu spelas:** Visar aktuell låt.
+6.  **Status:** Visar aktuell aktivitet.
+7.  **Nu spelas:** Visar aktuell låt.
 
 **Tekniskt:**
 Programmet startar en lokal HTTP-server för att kunna strömma filerna. Din dator måste vara på och i samma nätverk. Brandväggen får inte blockera port 8000 (eller nästa lediga).
+Utan fönster: kör `python chromast_daemon.py` och styr uppspelningen via JSON-API:t på http://127.0.0.1:8765/api/ (se chromast_daemon.py).
 
 **Felsökning:**
 *   **Enheter hittas inte:** Kontrollera nätverk, Wi-Fi, brandvägg. Prova "Uppdatera enheter".
 *   **Låten spelas inte:** Kontrollera statusfältet, filformat, nätverk. Se 'mp3_to_chromecast.log'.
+*   **Långsam start eller glapp mellan låtar:** Klicka "Exportera spår..." och spara tidsmätningarna för de senaste låtarna (JSON) att bifoga i felrapporten.
 *   **GUI fryser:** Bör inte hända. Rapportera felet om det sker till clas.klasson@gmail.com.
 
 **Avsluta:** Stäng fönstret. HTTP-servern stängs ner.
 """
 
-# Globala variabler
-chromecasts = []
-cast_dict = {}
-playlist = []
-current_song_index = 0
-httpd = None
-PORT = 8000
-server_directory = None
+# Globala variabler (GUI); uppspelningen ligger i chromast_engine
 volume_label = None
 volume_slider = None
 status_label = None
 now_playing_label = None
-current_cast = None
-manual_playback_control = False
-
-
-class CustomHandler(http.server.SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        try:
-            decoded_path = urllib.parse.unquote(path)
-            base_dir = server_directory or os.getcwd()
-            requested_file_path = os.path.join(base_dir, decoded_path.lstrip('/'))
-            real_base_dir = os.path.realpath(base_dir)
-            real_requested_path = os.path.realpath(requested_file_path)
-
-            if not real_requested_path.startswith(real_base_dir):
-                logging.warning(f"HTTP Server: Försök till otillåten sökväg: {path} -> {real_requested_path}")
-                return None
-            logging.debug(f"HTTP Server: Serverar fil: {real_requested_path}")
-            return real_requested_path
-        except Exception as e:
-            logging.error(f"HTTP Server: Fel vid översättning av sökväg {path}: {e}", exc_info=True)
-            return None
-
-def get_local_ip():
-    logging.debug("Hämtar lokal IP")
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        IP = s.getsockname()[0]
-    except Exception as e:
-        logging.error(f"Kunde inte hämta lokal IP: {e}", exc_info=True)
-        IP = "127.0.0.1"
-        root.after(0, lambda: set_status("Varning: Kunde inte hämta lokal IP. Använder 127.0.0.1."))
-    finally:
-        s.close()
-    logging.debug(f"Hämtade IP {IP}")
-    return IP
-
-def start_http_server(directory):
-    global httpd, server_directory, PORT
-    logging.debug(f"Försöker starta HTTP-server för katalog: {directory}")
-    abs_directory = os.path.abspath(directory)
-    abs_server_directory = os.path.abspath(server_directory) if server_directory else None
-
-    if httpd and abs_server_directory == abs_directory:
-        logging.debug("HTTP-server körs redan för samma katalog.")
-        return True
-    if httpd:
-        logging.debug("Stänger befintlig HTTP-server...")
-        try:
-            httpd.shutdown()
-            httpd.server_close()
-            time.sleep(0.1)
-            logging.debug("Befintlig server stängd.")
-        except Exception as e:
-            logging.error(f"Kunde inte stänga befintlig HTTP-server: {e}", exc_info=True)
-        httpd = None
-        server_directory = None
-
-    server_directory = abs_directory
-    max_attempts = 20
-    current_port = PORT
-    for attempt in range(max_attempts):
-        try:
-            server = socketserver.ThreadingTCPServer(("", current_port), CustomHandler)
-            httpd = server
-            PORT = current_port
-            threading.Thread(target=httpd.serve_forever, daemon=True, name="HTTPServerThread").start()
-            logging.info(f"HTTP-server start initierad på port {PORT}")
-            time.sleep(0.05)
-            return True
-        except OSError as e:
-            logging.warning(f"Port {current_port} misslyckades: {e}. Försöker nästa port.")
-            current_port += 1
-            if current_port > 65535: current_port = 8000
-    logging.error(f"Kunde inte starta HTTP-server efter {max_attempts} försök.")
-    root.after(0, lambda: set_status("Kunde inte starta HTTP-server. Kontrollera brandvägg/andra program."))
-    httpd = None
-    server_directory = None
-    return False
-
-def run_in_thread(target_func, *args, callback_success=None, callback_failure=None):
-    """Kör en funktion i en separat daemon-tråd och hanterar callbacks."""
-    def wrapper():
-        thread_name = threading.current_thread().name
-        logging.debug(f"Tråd '{thread_name}' startad för: {target_func.__name__}")
-        try:
-            result = target_func(*args)
-            logging.debug(f"Tråd '{thread_name}' för {target_func.__name__} slutförd med resultat: {result is not None}")
-            if callback_success:
-                root.after(0, lambda: callback_success(result))
-        except Exception as e:
-            logging.error(f"Fel i trådad funktion {target_func.__name__} (tråd '{thread_name}'): {e}", exc_info=True)
-            if callback_failure:
-                root.after(0, lambda: callback_failure(e))
-        logging.debug(f"Tråd '{thread_name}' för {target_func.__name__} avslutas.")
-
-    thread = threading.Thread(target=wrapper, daemon=True, name=f"{target_func.__name__}Thread")
-    thread.start()
-    return thread
-
-# --- Bakgrundsfunktioner för Chromecast (körs i trådar) ---
-
-def _bg_cast_to_google_home(mp3_file_path, selected_device_name):
-    global current_cast, manual_playback_control
-    logging.debug(f"BG: Förbereder cast av {mp3_file_path} till {selected_device_name}")
-    cast = cast_dict.get(selected_device_name)
-    if not cast:
-        logging.error(f"BG: Högtalare '{selected_device_name}' hittades inte.")
-        root.after(0, lambda: set_status(f"Fel: Högtalare '{selected_device_name}' hittades inte."))
-        root.after(0, uppdatera_dropdown_action) # Försök uppdatera
-        return False
-
-    directory = os.path.dirname(mp3_file_path)
-    filename = os.path.basename(mp3_file_path)
-    abs_directory = os.path.abspath(directory)
-    abs_server_directory = os.path.abspath(server_directory) if server_directory else None
-
-    if not httpd or abs_server_directory != abs_directory:
-         logging.error(f"BG: HTTP-servern felkonfigurerad ('{abs_server_directory}' vs '{abs_directory}').")
-         root.after(0, lambda: set_status("Fel: HTTP-servern felkonfigurerad."))
-         return False
-
-    ip = get_local_ip()
-    mp3_url = f"http://{ip}:{PORT}/{urllib.parse.quote(filename)}"
-    logging.info(f"BG: Försöker spela URL: {mp3_url}")
-
-    cast.wait() # Blockerande
-    if current_cast and current_cast != cast:
-        logging.debug("BG: Byter aktiv cast-enhet.")
-    current_cast = cast
-    manual_playback_control = False
-    mc = cast.media_controller
-    root.after(0, lambda: set_status(f"Laddar: {filename}"))
-    mc.play_media(mp3_url, 'audio/mp3')
-
-    timeout_start = time.time()
-    while mc.status is None or mc.status.player_state not in ['PLAYING', 'BUFFERING', 'PAUSED']:
-        if time.time() - timeout_start > 20:
-            logging.warning(f"BG: Timeout vid laddning av {filename}")
-            root.after(0, lambda: set_status(f"Fel: Timeout vid uppspelning av {filename}."))
-            current_cast = None
-            return False
-        if not cast.status or not cast.status.is_connected:
-            logging.warning("BG: Cast kopplades ifrån under laddning.")
-            root.after(0, lambda: set_status("Chromecast kopplades ifrån."))
-            current_cast = None
-            return False
-        time.sleep(0.5)
-
-    if mc.status.player_state == 'PAUSED': mc.play()
-    root.after(0, lambda: set_status(f"Spelar: {filename}"))
-    root.after(0, lambda: now_playing_label.config(text=f"Nu spelas: {filename}"))
-    run_in_thread(update_volume_label_bg, cast) # Uppdatera volym i tråd
-    root.after(0, update_playlist_display_gui)
-    run_in_thread(_bg_check_if_song_finished, cast, selected_device_name)
-    logging.info(f"BG: Uppspelning av {filename} startad.")
-    return True
-
-
-def _bg_check_if_song_finished(cast, selected_device_name):
-    global current_song_index, current_cast, manual_playback_control
-    logging.debug(f"BG_CHECK: Startar för {selected_device_name}")
-    mc = cast.media_controller
-    while cast.status and cast.status.is_connected and current_cast == cast and \
-          mc.status and mc.status.player_state in ['PLAYING', 'BUFFERING']:
-        time.sleep(3)
-        if manual_playback_control:
-            logging.debug("BG_CHECK: Manuell kontroll, avslutar.")
-            return
-        if not cast.status or not cast.status.is_connected:
-            logging.warning("BG_CHECK: Cast kopplades ifrån.")
-            root.after(0, lambda: set_status("Chromecast kopplades ifrån."))
-            current_cast = None; root.after(0, lambda: now_playing_label.config(text="Nu spelas: Ingen låt"))
+displayed_session = None # Sessionen som visas i GUI:t (ändras bara från GUI-tråden)
+
+class VirtualPlaylistView:
+    """Visar en PlaylistModel på en Canvas och ritar bara de rader som syns. Att flytta markeringen
+    för aktuell låt kostar två radändringar oavsett listans längd."""
+    def __init__(self, parent, model, on_activate, font, yscrollcommand=None, xscrollcommand=None, height=10):
+        self.model = model
+        self.on_activate = on_activate
+        self.font = tkfont.Font(root=parent, font=font)
+        self.row_height = self.font.metrics('linespace') + 2
+        self.canvas = tk.Canvas(parent, bg="white", highlightthickness=1, highlightbackground="#c0c0c0",
+                                height=self.row_height * height, xscrollcommand=xscrollcommand)
+        self.yscrollcommand = yscrollcommand
+        self.first_row = 0 # Index för översta synliga raden
+        self.row_items = [] # Canvas-textobjekt, ett per synlig rad
+        self.row_indices = [] # Vilket listindex varje textobjekt visar just nu
+        self.text_width = 0 # Bredaste rad som ritats, styr horisontell rullning
+        self.current_index = -1
+        self.selected_index = -1
+        self.selection_item = self.canvas.create_rectangle(0, 0, 0, 0, fill="#cce4f7", outline="", state='hidden')
+
+        # Modellen kan ändras från motorns trådar (t.ex. metadata); ändringarna ritas i GUI-tråden
+        self.model_listener = lambda change, start, count: self.canvas.after(0, self.on_model_change, change, start, count)
+        model.add_listener(self.model_listener)
+        self.canvas.bind('<Configure>', lambda e: self.render())
+        self.canvas.bind('<Button-1>', self.on_click)
+        self.canvas.bind('<Double-1>', self.on_double_click)
+        self.canvas.bind('<MouseWheel>', lambda e: self.scroll_rows(-1 if e.delta > 0 else 1, 'units', 3))
+        self.canvas.bind('<Button-4>', lambda e: self.scroll_rows(-1, 'units', 3))
+        self.canvas.bind('<Button-5>', lambda e: self.scroll_rows(1, 'units', 3))
+
+    def pack(self, **kwargs):
+        self.canvas.pack(**kwargs)
+
+    def set_model(self, model):
+        """Byter lista som visas, t.ex. när en annan enhets session väljs."""
+        self.model.remove_listener(self.model_listener)
+        self.model = model
+        model.add_listener(self.model_listener)
+        self.first_row = 0
+        self.text_width = 0
+        self.current_index = self.selected_index = -1
+        self.row_indices = [None] * len(self.row_items)
+        self.render()
+
+    def visible_row_count(self):
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def yview(self, *args):
+        # Samma protokoll som Listbox.yview så att en vanlig Scrollbar kan styra vyn
+        if args and args[0] == 'moveto':
+            self.set_first_row(int(float(args[1]) * len(self.model)))
+        elif args and args[0] == 'scroll':
+            self.scroll_rows(int(args[1]), args[2])
+
+    def xview(self, *args):
+        self.canvas.xview(*args)
+
+    def scroll_rows(self, amount, what, step=1):
+        rows = self.visible_row_count() if what == 'pages' else step
+        self.set_first_row(self.first_row + amount * rows)
+
+    def set_first_row(self, first_row):
+        max_first = max(0, len(self.model) - self.visible_row_count())
+        first_row = max(0, min(first_row, max_first))
+        if first_row != self.first_row:
+            self.first_row = first_row
+            self.render()
+
+    def see(self, index):
+        visible = self.visible_row_count()
+        if not (self.first_row <= index < self.first_row + visible):
+            self.set_first_row(index - visible // 2)
+
+    def on_model_change(self, change, start, count):
+        if change == 'update':
+            self.row_indices = [None] * len(self.row_items) # Tvinga ny text på synliga rader
+        elif change == 'remove':
+            self.row_indices = [None] * len(self.row_items) # Samma index kan nu visa en annan låt
+            if self.current_index >= start: self.current_index = -1
+            if self.selected_index >= start: self.selected_index = -1
+            if len(self.model) == 0: self.text_width = 0
+            self.set_first_row(min(self.first_row, len(self.model)))
+        # Rita bara om ifall ändringen berör synliga rader; annars räcker det att uppdatera rullningslisten
+        if start < self.first_row + self.visible_row_count():
+            self.render()
+        else:
+            self.update_scrollbar()
+
+    def render(self):
+        visible = self.visible_row_count() + 1 # En extra rad täcker delvis synliga rader
+        while len(self.row_items) < visible:
+            self.row_items.append(self.canvas.create_text(4, 0, anchor='nw', font=self.font))
+            self.row_indices.append(None)
+        total = len(self.model)
+        for slot, item in enumerate(self.row_items):
+            index = self.first_row + slot
+            if slot >= visible or index >= total:
+                if self.row_indices[slot] is not None:
+                    self.canvas.itemconfig(item, text="")
+                    self.row_indices[slot] = None
+                continue
+            if self.row_indices[slot] != index:
+                name = self.model.display_name(index)
+                self.canvas.itemconfig(item, text=name)
+                self.canvas.coords(item, 4, slot * self.row_height + 1)
+                self.row_indices[slot] = index
+                self.text_width = max(self.text_width, self.font.measure(name) + 8)
+            self.canvas.itemconfig(item, fill=self.row_color(index))
+        self.place_selection()
+        self.canvas.configure(scrollregion=(0, 0, max(self.text_width, self.canvas.winfo_width()), self.canvas.winfo_height()))
+        self.update_scrollbar()
+
+    def row_color(self, index):
+        return 'blue' if index == self.current_index else 'black'
+
+    def place_selection(self):
+        slot = self.selected_index - self.first_row
+        if self.selected_index < 0 or not (0 <= slot < len(self.row_items)):
+            self.canvas.itemconfig(self.selection_item, state='hidden')
             return
-        if current_cast != cast:
-            logging.debug("BG_CHECK: Current cast ändrad, avslutar.")
+        y = slot * self.row_height
+        self.canvas.coords(self.selection_item, 0, y, max(self.text_width, self.canvas.winfo_width()), y + self.row_height)
+        self.canvas.itemconfig(self.selection_item, state='normal')
+        self.canvas.tag_lower(self.selection_item)
+
+    def update_scrollbar(self):
+        if not self.yscrollcommand: return
+        total = len(self.model)
+        if total == 0:
+            self.yscrollcommand(0.0, 1.0)
             return
+        self.yscrollcommand(self.first_row / total, min(1.0, (self.first_row + self.visible_row_count()) / total))
 
-    logging.debug(f"BG_CHECK: Loop avslutad. State: {mc.status.player_state if mc.status else 'None'}.")
-    if manual_playback_control or current_cast != cast: return
-
-    if cast.status and cast.status.is_connected and mc.status and mc.status.player_state == 'IDLE':
-        if playlist and current_song_index < len(playlist) - 1:
-            logging.info("BG_CHECK: Nästa låt.")
-            current_song_index += 1
-            next_song = playlist[current_song_index]
-            root.after(0, lambda: run_in_thread(_bg_cast_to_google_home, next_song, selected_device_name))
-        elif playlist and current_song_index >= len(playlist) - 1:
-            logging.info("BG_CHECK: Spellistan klar.")
-            root.after(0, lambda: set_status("Spellistan är klar."))
-            root.after(0, lambda: now_playing_label.config(text="Nu spelas: Ingen låt"))
-            root.after(0, update_playlist_display_gui) # Rensa markering
-            current_cast = None
-
-
-def _bg_adjust_volume(selected_device_name, volume_float):
-    cast = cast_dict.get(selected_device_name)
-    if not cast:
-        logging.error(f"BG_VOL: Högtalare '{selected_device_name}' hittades inte.")
-        root.after(0, lambda: set_status("Vald högtalare hittades inte."))
-        return
-    cast.wait()
-    new_volume = max(0.0, min(1.0, volume_float / 100.0))
-    cast.set_volume(new_volume)
-    logging.info(f"BG_VOL: Volym satt till {int(new_volume*100)}% på {selected_device_name}.")
-    # Volymen uppdateras visuellt via statuslyssnare eller manuellt anrop av update_volume_label_bg
-    run_in_thread(update_volume_label_bg, cast)
-
-
-def update_volume_label_bg(cast_obj):
-    if not cast_obj or not cast_obj.status: return # Om cast_obj är None eller saknar status
-    if cast_obj.status.volume_level is not None:
-        volume = int(cast_obj.status.volume_level * 100)
-        root.after(0, lambda: volume_label.config(text=f"Volym: {volume}%"))
-        root.after(0, lambda: volume_slider.set(volume))
-    else:
-        root.after(0, lambda: volume_label.config(text="Volym: Okänd"))
-
-
-def _bg_pause_playback(selected_device_name):
-    global manual_playback_control
-    cast = cast_dict.get(selected_device_name)
-    if not cast: return
-    cast.wait()
-    mc = cast.media_controller
-    if mc.status and mc.status.player_state == 'PLAYING':
-        mc.pause(); manual_playback_control = True
-        root.after(0, lambda: set_status("Uppspelning pausad."))
-    elif mc.status and mc.status.player_state == 'PAUSED':
-        mc.play(); manual_playback_control = False # Spelar nu, automatisk nästa låt kan ske
-        root.after(0, lambda: set_status("Uppspelning återupptagen."))
-
-
-def _bg_stop_playback(selected_device_name):
-    global manual_playback_control, current_cast
-    cast = cast_dict.get(selected_device_name)
-    if not cast: return
-    cast.wait()
-    mc = cast.media_controller
-    mc.stop(); manual_playback_control = True
-    root.after(0, lambda: set_status("Uppspelning stoppad."))
-    root.after(0, lambda: now_playing_label.config(text="Nu spelas: Ingen låt"))
-    if current_cast == cast: current_cast = None
-
-
-def _bg_hitta_enheter():
-    global chromecasts, cast_dict
-    logging.debug("BG_SCAN: Söker Chromecast-enheter")
-    try:
-        found_casts, _ = pychromecast.get_chromecasts()
-        cast_dict = {cc.name: cc for cc in found_casts}
-        chromecasts = found_casts # Uppdatera globala listan med cast-objekt
-        device_names = [cc.name for cc in found_casts]
-        logging.info(f"BG_SCAN: Hittade {len(device_names)} enheter.")
-        return device_names
-    except pychromecast.error.ChromecastConnectionError as e:
-        logging.error(f"BG_SCAN: Kunde inte hitta Chromecast-enheter: {e}", exc_info=True)
-        return [] # Returnera tom lista vid fel
-    except Exception as e:
-         logging.error(f"BG_SCAN: Oväntat fel vid enhetssökning: {e}", exc_info=True)
-         return []
-
-
-# --- GUI Event Handlers (körs i GUI-tråden, startar bakgrundstrådar) ---
+    def recolor(self, index):
+        slot = index - self.first_row
+        if 0 <= slot < len(self.row_items) and self.row_indices[slot] == index:
+            self.canvas.itemconfig(self.row_items[slot], fill=self.row_color(index))
+
+    def set_current(self, index):
+        """Flyttar markeringen för aktuell låt; ritar bara om den gamla och den nya raden."""
+        old_index, self.current_index = self.current_index, index
+        if old_index != index: self.recolor(old_index)
+        self.recolor(index)
+        if 0 <= index < len(self.model):
+            self.selected_index = index
+            self.place_selection()
+            self.see(index)
+
+    def row_at(self, y):
+        index = self.first_row + int(self.canvas.canvasy(y)) // self.row_height
+        return index if 0 <= index < len(self.model) else -1
+
+    def on_click(self, event):
+        self.canvas.focus_set()
+        self.selected_index = self.row_at(event.y)
+        self.place_selection()
+
+    def on_double_click(self, event):
+        index = self.row_at(event.y)
+        if index >= 0: self.on_activate(index)
+
+
+# --- GUI Event Handlers (körs i GUI-tråden; uppspelningen styrs via chromast_engine) ---
 
 def välj_filer_action():
-    filepaths = filedialog.askopenfilenames(filetypes=[("MP3 filer", "*.mp3")])
+    filepaths = filedialog.askopenfilenames(filetypes=[
+        ("Ljudfiler", " ".join(f"*{ext}" for ext in AUDIO_EXTENSIONS)), ("MP3 filer", "*.mp3")])
     if not filepaths: return
-    selected_device = device_var.get()
-    if not selected_device:
-        root.after(0, lambda: set_status("Välj en Chromecast-högtalare först."))
+    device_name = device_var.get()
+    if not device_name:
+        set_status("Välj en Chromecast-högtalare först.")
         return
-
-    global playlist, current_song_index
-    playlist = list(filepaths)[:100]
-    current_song_index = 0
-    root.after(0, update_playlist_display_gui)
-    root.after(0, lambda: set_status(f"Valde {len(playlist)} låtar. Förbereder..."))
-
-    if playlist:
-        first_file_directory = os.path.dirname(playlist[0])
-        if start_http_server(first_file_directory):
-            run_in_thread(_bg_cast_to_google_home, playlist[0], selected_device)
-        else:
-            root.after(0, lambda: set_status("Kunde inte starta HTTP-server. Försök igen."))
-            playlist = []; current_song_index = 0; root.after(0, update_playlist_display_gui)
+    set_status(f"Valde {len(filepaths)} låtar. Förbereder...")
+    engine.queue_tracks(device_name, filepaths, replace=True)
+    update_playlist_display_gui()
+
+def current_session():
+    """Sessionen för enheten som är vald i listan; kontrollerna styr den."""
+    device_name = device_var.get()
+    return engine.get_session(device_name) if device_name else None
+
+def show_session(session):
+    # Visar sessionens spellista, aktuella låt och grupp när en annan enhet väljs i listan
+    global displayed_session
+    if session is displayed_session: return
+    displayed_session = session
+    playlist_view.set_model(session.playlist)
+    update_playlist_display_gui()
+    now_playing_label.config(text=f"Nu spelas: {session.now_playing or 'Ingen låt'}")
+    group_label.config(text=f"Grupp: {', '.join(session.group_members)}" if session.group_members else "")
+
+def on_engine_event(event, data):
+    # Motorns händelser kommer från dess trådar; widgetarna uppdateras bara i GUI-tråden
+    root.after(0, lambda: handle_engine_event(event, data))
+
+def handle_engine_event(event, data):
+    device_name = data.get('device')
+    shown = displayed_session is not None and device_name == displayed_session.device_name
+    if event == 'status':
+        set_status(data['text'] if device_name is None or shown else f"{device_name}: {data['text']}")
+    elif event == 'now_playing' and shown:
+        now_playing_label.config(text=f"Nu spelas: {data['filename'] or 'Ingen låt'}")
+    elif event == 'position' and shown:
+        update_playlist_display_gui()
+    elif event == 'volume' and shown:
+        show_volume(data['level'])
+    elif event == 'devices':
+        uppdatera_dropdown_gui_callback(data['names'])
+
+def show_volume(volume_level):
+    if volume_level is not None:
+        volume = int(volume_level * 100)
+        volume_label.config(text=f"Volym: {volume}%")
+        volume_slider.set(volume)
+    else:
+        volume_label.config(text="Volym: Okänd")
 
 def adjust_volume_action(volume_str):
-    selected_device = device_var.get()
-    if not selected_device: return
+    device_name = device_var.get()
+    if not device_name: return
     try: volume_float = float(volume_str)
     except ValueError: logging.warning(f"Ogiltigt volymvärde: {volume_str}"); return
-    run_in_thread(_bg_adjust_volume, selected_device, volume_float)
+    engine.set_volume(device_name, volume_float)
+
+def pause_action():
+    if device_var.get(): engine.pause(device_var.get())
+    else: set_status("Välj en enhet först.")
+
+def stop_action():
+    if device_var.get(): engine.stop(device_var.get())
+    else: set_status("Välj en enhet först.")
 
 def uppdatera_dropdown_action():
-    root.after(0, lambda: set_status("Söker efter enheter..."))
-    run_in_thread(_bg_hitta_enheter, callback_success=uppdatera_dropdown_gui_callback)
+    # Bläddraren håller enhetslistan aktuell; här synkas bara listan och cachen
+    device_names = engine.device_names()
+    uppdatera_dropdown_gui_callback(device_names)
+    if device_names: engine.run_in_thread(engine.save_device_cache)
+
+def on_device_selected_action(event=None):
+    device_name = device_var.get()
+    if not device_name: return
+    engine.cast_pool.prime(device_name)
+    show_session(engine.get_session(device_name))
+    engine.report_volume(engine.cast_dict.get(device_name))
 
 def uppdatera_dropdown_gui_callback(device_names):
-    logging.debug(f"GUI_CB: Mottog {len(device_names)} enheter för dropdown.")
+    logging.debug("GUI_CB: Mottog %s enheter för dropdown.", len(device_names))
     device_dropdown['values'] = device_names
     if device_names:
         current_selection = device_var.get()
         if not current_selection or current_selection not in device_names:
             device_var.set(device_names[0]) # Välj första om inget valt eller om nuvarande försvunnit
-        root.after(0, lambda: set_status(f"{len(device_names)} högtalare hittade. '{device_var.get()}' vald."))
-        cast = cast_dict.get(device_var.get())
-        if cast: run_in_thread(update_volume_label_bg, cast)
+        show_session(engine.get_session(device_var.get()))
+        set_status(f"{len(device_names)} högtalare hittade. '{device_var.get()}' vald.")
+        engine.report_volume(engine.cast_dict.get(device_var.get()))
     else:
         device_var.set("")
-        root.after(0, lambda: set_status("Inga Chromecast-enheter hittades."))
+        set_status("Söker efter enheter..." if engine.cast_browser is None else "Inga Chromecast-enheter hittades ännu.")
 
 def update_playlist_display_gui():
-    # Denna körs alltid i GUI-tråden
-    current_items_in_listbox = [playlist_listbox.get(i) for i in range(playlist_listbox.size())]
-    new_items_to_display = [os.path.basename(song) for song in playlist]
-
-    if current_items_in_listbox != new_items_to_display:
-        playlist_listbox.delete(0, tk.END)
-        for song_name in new_items_to_display:
-            playlist_listbox.insert(tk.END, song_name)
-
-    for i in range(playlist_listbox.size()):
-        playlist_listbox.itemconfig(i, {'fg': 'black'}) # Återställ färg
-    if 0 <= current_song_index < playlist_listbox.size():
-        playlist_listbox.itemconfig(current_song_index, {'fg': 'blue'})
-        playlist_listbox.selection_clear(0, tk.END)
-        playlist_listbox.selection_set(current_song_index)
-        playlist_listbox.see(current_song_index) # Scrolla till aktuell
-
-
-def play_selected_song_action(event):
-    selection = playlist_listbox.curselection()
-    if not selection: return
-    index = selection[0]
-    selected_device = device_var.get()
-    if not selected_device:
-        root.after(0, lambda: set_status("Välj en Chromecast-högtalare först."))
+    # Denna körs alltid i GUI-tråden. Innehållet uppdateras av modellens ändringar; här flyttas bara markeringen.
+    if displayed_session: playlist_view.set_current(displayed_session.current_song_index)
+
+
+def play_selected_song_action(index):
+    device_name = device_var.get()
+    if not device_name:
+        set_status("Välj en Chromecast-högtalare först.")
         return
-    if 0 <= index < len(playlist):
-        global current_song_index
-        current_song_index = index
-        selected_file_directory = os.path.dirname(playlist[current_song_index])
-        if start_http_server(selected_file_directory):
-            run_in_thread(_bg_cast_to_google_home, playlist[current_song_index], selected_device)
-        else:
-            root.after(0, lambda: set_status("Kunde inte starta HTTP-server för vald låt."))
+    engine.play_index(device_name, index)
 
 def clear_playlist_action():
-    global playlist, current_song_index, current_cast, manual_playback_control
-    if current_cast:
-        run_in_thread(_bg_stop_playback, current_cast.name) # Stoppa i tråd
-    playlist = []
-    current_song_index = 0
-    current_cast = None # Nollställ current_cast
-    manual_playback_control = False # Återställ
-    root.after(0, update_playlist_display_gui)
-    root.after(0, lambda: set_status("Spellista rensad."))
-    root.after(0, lambda: now_playing_label.config(text="Nu spelas: Ingen låt"))
+    device_name = device_var.get()
+    if not device_name: return
+    engine.clear(device_name)
+    update_playlist_display_gui()
+    set_status("Spellista rensad.")
+
+
+def visa_grupp_action():
+    session = current_session()
+    if not session:
+        set_status("Välj en Chromecast-högtalare först.")
+        return
+    device_names = [name for name in engine.device_names() if name != session.device_name]
+    if not device_names:
+        set_status("Inga andra högtalare hittade ännu.")
+        return
+    window = tk.Toplevel(root)
+    window.title("Högtalargrupp")
+    window.configure(bg="#f0f2f5")
+    ttk.Label(window, text=f"Spela samtidigt som {session.device_name} på:",
+              font=('Segoe UI', 10, 'bold')).pack(anchor='w', padx=10, pady=(10,5))
+    selections = {}
+    for device_name in device_names:
+        selections[device_name] = tk.BooleanVar(value=device_name in session.group_members)
+        ttk.Checkbutton(window, text=device_name, variable=selections[device_name]).pack(anchor='w', padx=20)
+
+    def apply():
+        set_group(session, [name for name in device_names if selections[name].get()])
+        window.destroy()
+
+    def dissolve():
+        set_group(session, [])
+        window.destroy()
+
+    button_frame = ttk.Frame(window, padding="10")
+    button_frame.pack(fill='x')
+    ttk.Button(button_frame, text="Använd", command=apply).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(button_frame, text="Upplös grupp", command=dissolve).pack(side=tk.LEFT)
+
+def set_group(session, other_devices):
+    # Sessionens enhet leder alltid gruppen
+    members = engine.set_group(session.device_name, other_devices)
+    if session is displayed_session:
+        group_label.config(text=f"Grupp: {', '.join(members)}" if members else "")
+    set_status(f"Gruppen ({len(members)} högtalare) används från nästa låt." if members else "Gruppen upplöst.")
+
+def toggle_queue_mode_action():
+    engine.set_queue_mode(queue_mode_var.get())
+
+
+def enqueue_tracks(paths):
+    """Lägger till paths sist i den valda enhetens spellista och startar uppspelning om inget spelas."""
+    if not paths: return
+    device_name = device_var.get()
+    if not device_name:
+        set_status("Välj en Chromecast-högtalare först.")
+        return
+    set_status(f"La till {len(paths)} låtar i spellistan.")
+    if engine.queue_tracks(device_name, paths) is not None:
+        update_playlist_display_gui()
+
+
+def _bg_add_library_root(directory, on_done):
+    root_path = engine.music_library.add_root(directory)
+    engine.library_watcher.add_root(root_path)
+    changed, _ = engine.music_library.rescan(progress=lambda n: root.after(0, lambda: set_status(f"Indexerar... {n} filer")))
+    root.after(0, lambda: set_status(f"Biblioteket uppdaterat: {changed} nya/ändrade filer."))
+    root.after(0, on_done)
+
+
+def visa_bibliotek_action():
+    music_library = engine.music_library
+    if not music_library:
+        set_status("Biblioteket öppnas fortfarande, försök igen strax.")
+        return
+    window = tk.Toplevel(root)
+    window.title("Musikbibliotek")
+    window.geometry("700x500")
+    window.configure(bg="#f0f2f5")
+    results = []
+
+    toolbar = ttk.Frame(window, padding="10 10 10 5")
+    toolbar.pack(fill='x')
+    count_label = ttk.Label(toolbar, text="")
+    search_var = tk.StringVar()
+    search_job = [None]
+
+    def run_search():
+        search_job[0] = None
+        results[:] = music_library.search(search_var.get())
+        result_listbox.delete(0, tk.END)
+        for track in results:
+            artist = f"{track['artist']} – " if track['artist'] else ""
+            result_listbox.insert(tk.END, f"{artist}{track['title'] or os.path.basename(track['path'])}")
+        count_label.config(text=f"{len(results)} träffar av {music_library.count()} låtar")
+
+    def schedule_search(*_):
+        # Vänta tills användaren slutat skriva en kort stund
+        if search_job[0]: window.after_cancel(search_job[0])
+        search_job[0] = window.after(150, run_search)
+
+    def add_folder():
+        directory = filedialog.askdirectory(parent=window, title="Välj musikmapp")
+        if directory:
+            set_status("Indexerar musikmapp...")
+            engine.run_in_thread(_bg_add_library_root, directory, run_search)
+
+    def rescan():
+        set_status("Skannar om biblioteket...")
+        engine.run_in_thread(music_library.rescan, callback_success=lambda r: root.after(0, lambda: (
+            set_status(f"Omskanning klar: {r[0]} nya/ändrade, {r[1]} borttagna."), run_search())))
+
+    def add_selected():
+        enqueue_tracks([results[i]['path'] for i in result_listbox.curselection()])
+
+    def add_all():
+        enqueue_tracks([track['path'] for track in results])
+
+    ttk.Button(toolbar, text="Lägg till mapp...", command=add_folder).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(toolbar, text="Skanna om", command=rescan).pack(side=tk.LEFT, padx=(0,10))
+    count_label.pack(side=tk.LEFT)
+
+    search_frame = ttk.Frame(window, padding="10 0")
+    search_frame.pack(fill='x')
+    ttk.Label(search_frame, text="Sök:").pack(side=tk.LEFT, padx=(0,5))
+    search_entry = ttk.Entry(search_frame, textvariable=search_var)
+    search_entry.pack(side=tk.LEFT, fill='x', expand=True)
+    search_var.trace_add('write', schedule_search)
+
+    list_frame = ttk.Frame(window, padding="10 5")
+    list_frame.pack(fill=tk.BOTH, expand=True)
+    scroll = ttk.Scrollbar(list_frame); scroll.pack(side=tk.RIGHT, fill=tk.Y)
+    result_listbox = tk.Listbox(list_frame, selectmode=tk.EXTENDED, bg="white", font=('Segoe UI', 10), yscrollcommand=scroll.set)
+    result_listbox.pack(fill=tk.BOTH, expand=True)
+    scroll.config(command=result_listbox.yview)
+    result_listbox.bind('<Double-1>', lambda e: add_selected())
+
+    button_frame = ttk.Frame(window, padding="10 5 10 10")
+    button_frame.pack(fill='x')
+    ttk.Button(button_frame, text="Lägg till markerade i kön", command=add_selected).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(button_frame, text="Lägg till alla träffar", command=add_all).pack(side=tk.LEFT)
+
+    search_entry.focus_set()
+    run_search()
 
 
 def visa_hjalp_action():
@@ -432,6 +487,21 @@ def visa_hjalp_action():
     text_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=10, pady=10)
     scroll.config(command=text_widget.yview)
 
+def exportera_spar_action():
+    # Spåren per låt (chromast_metrics) som JSON i samma format som daemonens /api/traces. Sparas lokalt,
+    # eftersom spåren innehåller sökvägar och inte visas på mediaservern mot nätverket.
+    path = filedialog.asksaveasfilename(title="Exportera spår", defaultextension=".json",
+                                        initialfile="chromast_spar.json", filetypes=[("JSON", "*.json")])
+    if not path: return
+    exported = traces.export()
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traces': exported}, f, ensure_ascii=False, indent=1)
+    except OSError as e:
+        messagebox.showerror("Exportera spår", f"Kunde inte spara {path}:\n{e}")
+        return
+    set_status(f"{len(exported)} spår sparade i {os.path.basename(path)}.")
+
 def set_status(text):
     # Denna funktion anropas via root.after från trådar, så den körs i GUI-tråden.
     if status_label and status_label.cget("text") != text:
@@ -439,125 +509,157 @@ def set_status(text):
         logging.info(f"Status GUI: {text}") # Logga även statusändringar till fil
 
 def on_closing_action():
-    global httpd
     logging.info("Programmet stängs...")
-    if httpd:
-        logging.debug("Försöker stänga HTTP-server vid avslutning...")
-        try:
-            httpd.shutdown()
-            httpd.server_close()
-            logging.info("HTTP-server stängd.")
-        except Exception as e:
-            logging.error(f"Kunde inte stänga HTTP-servern helt vid avslutning: {e}", exc_info=True)
-    time.sleep(0.1)
+    engine.shutdown()
     root.destroy()
 
+def on_window_mapped(event):
+    # Motorn startas först när fönstret visats och ritats upp
+    if event.widget is not root: return
+    root.unbind('<Map>')
+    root.after_idle(start_engine)
+
+def start_engine():
+    engine.mark_startup('window')
+    engine.start()
+    if args.profile_startup:
+        check_startup_profile(time.monotonic() + PROFILE_STARTUP_TIMEOUT)
+
+def check_startup_profile(deadline):
+    # --profile-startup: vänta tills en enhet hittats via nätverket (eller tiden gått ut), skriv rapporten och avsluta
+    if 'first_discovery' not in engine.startup_marks and time.monotonic() < deadline:
+        root.after(50, check_startup_profile, deadline)
+        return
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': sys.version.split()[0], **engine.startup_report()}
+    text = json.dumps(report, ensure_ascii=False)
+    print(text)
+    logging.info(f"Startprofil: {text}")
+    if args.profile_output:
+        with open(args.profile_output, 'a', encoding='utf-8') as f:
+            f.write(text + '\n')
+    on_closing_action()
+
 
 # --- GUI Setup ---
-root = tk.Tk()
-root.title("MP3 till Chromecast")
-root.minsize(700, 650)
-root.geometry("700x650") # Startstorlek
-root.configure(bg="#f0f2f5")
-
-style = ttk.Style()
-style.theme_use('clam') # Eller 'alt', 'default', 'classic'
-style.configure('TFrame', background="#f0f2f5")
-style.configure('TLabel', background="#f0f2f5", font=('Segoe UI', 9))
-style.configure('TButton', font=('Segoe UI', 10, 'bold'), padding=(10,5), background="#4CAF50", foreground="white")
-style.map('TButton', background=[('active', '#45a049')]) # Mörkare grön vid hover/klick
-style.configure('Danger.TButton', background="#f44336", foreground="white") # Röd knapp för "Rensa"
-style.map('Danger.TButton', background=[('active', '#da190b')])
-style.configure('Horizontal.TScale', background="#f0f2f5")
-style.configure('TCombobox', font=('Segoe UI', 10), padding=5)
-style.map('TCombobox', fieldbackground=[('readonly', 'white')])
-
-
-# Toppsektion: Enhetsval och laddningsknapp
-top_frame = ttk.Frame(root, padding="10 10 10 0")
-top_frame.pack(fill='x')
-
-ttk.Label(top_frame, text="Välj Chromecast:", font=('Segoe UI', 12, 'bold')).pack(side=tk.LEFT, padx=(0,10))
-device_var = tk.StringVar()
-device_dropdown = ttk.Combobox(top_frame, textvariable=device_var, state='readonly', width=25, style='TCombobox')
-device_dropdown.pack(side=tk.LEFT, padx=(0,10), fill='x', expand=True)
-ttk.Button(top_frame, text="Uppdatera enheter", command=uppdatera_dropdown_action).pack(side=tk.LEFT)
-
-# Nu spelas-sektion
-now_playing_frame = ttk.Frame(root, padding="10 5")
-now_playing_frame.pack(fill='x')
-ttk.Label(now_playing_frame, text="Nu spelas:", font=('Segoe UI', 10, 'bold')).pack(anchor='w')
-now_playing_label = ttk.Label(now_playing_frame, text="Ingen låt", font=('Segoe UI', 10, 'italic'), wraplength=650)
-now_playing_label.pack(anchor='w', fill='x')
-
-# Kontrollsektion: Lägg till filer, Rensa spellista
-file_control_frame = ttk.Frame(root, padding="10 5")
-file_control_frame.pack(fill='x')
-ttk.Button(file_control_frame, text="Lägg till MP3-filer", command=välj_filer_action).pack(side=tk.LEFT, padx=(0,5))
-ttk.Button(file_control_frame, text="Rensa spellista", command=clear_playlist_action, style='Danger.TButton').pack(side=tk.LEFT)
-
-
-# Volymkontroll
-volume_control_frame = ttk.Frame(root, padding="10 5")
-volume_control_frame.pack(fill='x')
-ttk.Label(volume_control_frame, text="Volym:", font=('Segoe UI', 10, 'bold')).pack(side=tk.LEFT, padx=(0,5))
-volume_slider = ttk.Scale(volume_control_frame, from_=0, to=100, orient=tk.HORIZONTAL,
-                          length=200, command=adjust_volume_action) # command är nu adjust_volume_action
-volume_slider.set(50) # Default värde
-volume_slider.pack(side=tk.LEFT, padx=(0,5))
-volume_label = ttk.Label(volume_control_frame, text="Volym: 50%", font=('Segoe UI', 10)) # Startvärde
-volume_label.pack(side=tk.LEFT)
-
-# Spelkontroller: Paus/Spela, Stopp
-play_control_frame = ttk.Frame(root, padding="10 5")
-play_control_frame.pack(fill='x')
-ttk.Button(play_control_frame, text="Paus/Spela",
-           command=lambda: run_in_thread(_bg_pause_playback, device_var.get()) if device_var.get() else set_status("Välj en enhet först.")
-          ).pack(side=tk.LEFT, padx=(0,5))
-ttk.Button(play_control_frame, text="Stopp", style='Danger.TButton',
-           command=lambda: run_in_thread(_bg_stop_playback, device_var.get()) if device_var.get() else set_status("Välj en enhet först.")
-          ).pack(side=tk.LEFT)
-
-
-# Spellista
-playlist_frame = ttk.Frame(root, padding="10 5")
-playlist_frame.pack(fill=tk.BOTH, expand=True)
-
-ttk.Label(playlist_frame, text="Spellista:", font=('Segoe UI', 10, 'bold')).pack(anchor='w')
-scrollbar_y = ttk.Scrollbar(playlist_frame, orient=tk.VERTICAL)
-scrollbar_x = ttk.Scrollbar(playlist_frame, orient=tk.HORIZONTAL)
-
-playlist_listbox = tk.Listbox(playlist_frame,
-                              width=60, height=10, # Justera höjd efter behov
-                              bg="white", font=('Segoe UI', 10),
-                              yscrollcommand=scrollbar_y.set,
-                              xscrollcommand=scrollbar_x.set,
-                              selectmode=tk.SINGLE)
-
-scrollbar_y.config(command=playlist_listbox.yview)
-scrollbar_x.config(command=playlist_listbox.xview)
-
-scrollbar_y.pack(side=tk.RIGHT, fill=tk.Y)
-scrollbar_x.pack(side=tk.BOTTOM, fill=tk.X)
-playlist_listbox.pack(fill=tk.BOTH, expand=True, pady=(0,5)) # Lite padding under innan x-scrollbaren
-
-playlist_listbox.bind('<Double-1>', play_selected_song_action)
-
-
-# Bottensektion: Hjälpknapp och status
-bottom_frame = ttk.Frame(root, padding="10 10 10 10")
-bottom_frame.pack(fill='x')
-ttk.Button(bottom_frame, text="Hjälp", command=visa_hjalp_action).pack(side=tk.LEFT)
-status_label = ttk.Label(bottom_frame, text="Välkommen! Söker enheter...", foreground="#006d5b", font=('Segoe UI', 10, 'italic'), wraplength=500)
-status_label.pack(side=tk.LEFT, padx=20, fill='x', expand=True)
-
-
-# --- Programstart och avslutning ---
-# Sök efter enheter direkt när programmet startar
-root.after(100, uppdatera_dropdown_action) # Liten fördröjning för att GUI ska ritas upp först
-
-# Hantera stängning av fönstret
-root.protocol("WM_DELETE_WINDOW", on_closing_action)
-
-# Starta Tkinter event loop
-root.mainloop()
+# Skyddas av __main__-kontrollen så att metadata-processpoolens arbetsprocesser (spawn) kan importera modulen
+# utan att bygga ett fönster.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spela ljudfiler på Chromecast.")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="mät importtid, tid till uppritat fönster och till första enheten, skriv JSON och avsluta")
+    parser.add_argument('--profile-output', help="lägg till startprofilen som en JSON-rad i den här filen")
+    args = parser.parse_args()
+    # Loggning - endast till fil, via en skrivartråd (se chromast_logging). Ändra till logging.DEBUG för mer detaljer
+    setup_logging(LOG_FILE, level=logging.INFO)
+    engine.startup_started = startup_started
+    engine.mark_startup('imports', imports_done)
+
+    root = tk.Tk()
+    root.title("MP3 till Chromecast")
+    root.minsize(700, 650)
+    root.geometry("700x650") # Startstorlek
+    root.configure(bg="#f0f2f5")
+
+    style = ttk.Style()
+    style.theme_use('clam') # Eller 'alt', 'default', 'classic'
+    style.configure('TFrame', background="#f0f2f5")
+    style.configure('TLabel', background="#f0f2f5", font=('Segoe UI', 9))
+    style.configure('TButton', font=('Segoe UI', 10, 'bold'), padding=(10,5), background="#4CAF50", foreground="white")
+    style.map('TButton', background=[('active', '#45a049')]) # Mörkare grön vid hover/klick
+    style.configure('Danger.TButton', background="#f44336", foreground="white") # Röd knapp för "Rensa"
+    style.map('Danger.TButton', background=[('active', '#da190b')])
+    style.configure('Horizontal.TScale', background="#f0f2f5")
+    style.configure('TCombobox', font=('Segoe UI', 10), padding=5)
+    style.map('TCombobox', fieldbackground=[('readonly', 'white')])
+
+
+    # Toppsektion: Enhetsval och laddningsknapp
+    top_frame = ttk.Frame(root, padding="10 10 10 0")
+    top_frame.pack(fill='x')
+
+    ttk.Label(top_frame, text="Välj Chromecast:", font=('Segoe UI', 12, 'bold')).pack(side=tk.LEFT, padx=(0,10))
+    device_var = tk.StringVar()
+    device_dropdown = ttk.Combobox(top_frame, textvariable=device_var, state='readonly', width=25, style='TCombobox')
+    device_dropdown.pack(side=tk.LEFT, padx=(0,10), fill='x', expand=True)
+    device_dropdown.bind('<<ComboboxSelected>>', on_device_selected_action)
+    ttk.Button(top_frame, text="Uppdatera enheter", command=uppdatera_dropdown_action).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(top_frame, text="Grupp...", command=visa_grupp_action).pack(side=tk.LEFT)
+    group_label = ttk.Label(root, text="", padding="10 0", font=('Segoe UI', 9, 'italic'))
+    group_label.pack(fill='x')
+
+    # Nu spelas-sektion
+    now_playing_frame = ttk.Frame(root, padding="10 5")
+    now_playing_frame.pack(fill='x')
+    ttk.Label(now_playing_frame, text="Nu spelas:", font=('Segoe UI', 10, 'bold')).pack(anchor='w')
+    now_playing_label = ttk.Label(now_playing_frame, text="Ingen låt", font=('Segoe UI', 10, 'italic'), wraplength=650)
+    now_playing_label.pack(anchor='w', fill='x')
+
+    # Kontrollsektion: Lägg till filer, Rensa spellista
+    file_control_frame = ttk.Frame(root, padding="10 5")
+    file_control_frame.pack(fill='x')
+    ttk.Button(file_control_frame, text="Lägg till ljudfiler", command=välj_filer_action).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(file_control_frame, text="Bibliotek", command=visa_bibliotek_action).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(file_control_frame, text="Rensa spellista", command=clear_playlist_action, style='Danger.TButton').pack(side=tk.LEFT)
+
+
+    # Volymkontroll
+    volume_control_frame = ttk.Frame(root, padding="10 5")
+    volume_control_frame.pack(fill='x')
+    ttk.Label(volume_control_frame, text="Volym:", font=('Segoe UI', 10, 'bold')).pack(side=tk.LEFT, padx=(0,5))
+    volume_slider = ttk.Scale(volume_control_frame, from_=0, to=100, orient=tk.HORIZONTAL,
+                              length=200, command=adjust_volume_action) # command är nu adjust_volume_action
+    volume_slider.set(50) # Default värde
+    volume_slider.pack(side=tk.LEFT, padx=(0,5))
+    volume_label = ttk.Label(volume_control_frame, text="Volym: 50%", font=('Segoe UI', 10)) # Startvärde
+    volume_label.pack(side=tk.LEFT)
+
+    # Spelkontroller: Paus/Spela, Stopp
+    play_control_frame = ttk.Frame(root, padding="10 5")
+    play_control_frame.pack(fill='x')
+    ttk.Button(play_control_frame, text="Paus/Spela", command=pause_action).pack(side=tk.LEFT, padx=(0,5))
+    ttk.Button(play_control_frame, text="Stopp", style='Danger.TButton', command=stop_action).pack(side=tk.LEFT)
+    queue_mode_var = tk.BooleanVar(value=engine.queue_mode_enabled)
+    ttk.Checkbutton(play_control_frame, text="Gapless (köa på enheten)", variable=queue_mode_var,
+                    command=toggle_queue_mode_action).pack(side=tk.LEFT, padx=(15,0))
+
+
+    # Spellista
+    playlist_frame = ttk.Frame(root, padding="10 5")
+    playlist_frame.pack(fill=tk.BOTH, expand=True)
+
+    ttk.Label(playlist_frame, text="Spellista:", font=('Segoe UI', 10, 'bold')).pack(anchor='w')
+    scrollbar_y = ttk.Scrollbar(playlist_frame, orient=tk.VERTICAL)
+    scrollbar_x = ttk.Scrollbar(playlist_frame, orient=tk.HORIZONTAL)
+
+    playlist_view = VirtualPlaylistView(playlist_frame, PlaylistModel(engine.track_metadata), play_selected_song_action,
+                                        font=('Segoe UI', 10), height=10, # Justera höjd efter behov
+                                        yscrollcommand=scrollbar_y.set,
+                                        xscrollcommand=scrollbar_x.set)
+
+    scrollbar_y.config(command=playlist_view.yview)
+    scrollbar_x.config(command=playlist_view.xview)
+
+    scrollbar_y.pack(side=tk.RIGHT, fill=tk.Y)
+    scrollbar_x.pack(side=tk.BOTTOM, fill=tk.X)
+    playlist_view.pack(fill=tk.BOTH, expand=True, pady=(0,5)) # Lite padding under innan x-scrollbaren
+
+
+    # Bottensektion: Hjälpknapp och status
+    bottom_frame = ttk.Frame(root, padding="10 10 10 10")
+    bottom_frame.pack(fill='x')
+    ttk.Button(bottom_frame, text="Hjälp", command=visa_hjalp_action).pack(side=tk.LEFT)
+    ttk.Button(bottom_frame, text="Exportera spår...", command=exportera_spar_action).pack(side=tk.LEFT, padx=(5,0))
+    status_label = ttk.Label(bottom_frame, text="Välkommen! Söker enheter...", foreground="#006d5b", font=('Segoe UI', 10, 'italic'), wraplength=500)
+    status_label.pack(side=tk.LEFT, padx=20, fill='x', expand=True)
+
+
+    # --- Programstart och avslutning ---
+    # Motorn (HTTP-server, enhetssökning, bibliotek) startas så fort fönstret ritats upp
+    engine.add_event_listener(on_engine_event)
+    root.bind('<Map>', on_window_mapped)
+
+    # Hantera stängning av fönstret
+    root.protocol("WM_DELETE_WINDOW", on_closing_action)
+
+    # Starta Tkinter event loop
+    root.mainloop()
@@ -0,0 +1,477 @@
+"""Prestandamätning utan riktiga högtalare. Motorn (chromast_engine) körs som vanligt med sin HTTP-server,
+men enheterna i cast_dict är låtsasmottagare som följer Cast-mediaprotokollets tillstånd (BUFFERING, PLAYING,
+PAUSED, IDLE, QUEUE_LOAD/QUEUE_INSERT) och verkligen hämtar de serverade URL:erna.
+
+    python chromast_bench.py [--fetchers 8] [--tracks 5] [--output resultat.jsonl]
+
+Mäter tid från klick till första byte och till PLAYING, glappet mellan spår (med och utan gapless-kö),
+HTTP-genomströmning och latens (p50/p99) med N samtidiga hämtare, importtiden för motorn och pychromecast
+i en ny process, samt antal trådar och RSS. Resultatet
+skrivs som JSON till stdout; med --output läggs det dessutom till som en rad i en JSONL-fil så att körningar
+kan jämföras över tid."""
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+import uuid
+
+import chromast_engine as engine
+
+FETCH_CHUNK = 64 * 1024
+SAMPLE_INTERVAL = 0.02
+
+
+# --- Låtsasmottagare ---
+
+class FakeMediaStatus:
+    def __init__(self, player_state, content_id=None, idle_reason=None, media_session_id=None, duration=None,
+                 current_time=0.0):
+        self.player_state = player_state
+        self.content_id = content_id
+        self.idle_reason = idle_reason
+        self.media_session_id = media_session_id
+        self.duration = duration
+        self.adjusted_current_time = current_time
+
+
+class FakeFetch:
+    """Hämtar en URL i en egen tråd, som en mottagare som buffrar ett spår."""
+    def __init__(self, receiver, url):
+        self.receiver = receiver
+        self.url = url
+        self.first_byte = threading.Event()
+        self.done = threading.Event()
+        self.failed = False
+        self.size = 0
+        threading.Thread(target=self.run, daemon=True, name="FakeFetch").start()
+
+    def run(self):
+        try:
+            with urllib.request.urlopen(self.url, timeout=30) as response:
+                while True:
+                    data = response.read(FETCH_CHUNK)
+                    if not data: break
+                    if not self.first_byte.is_set():
+                        self.receiver.record('first_byte', self.url)
+                        self.first_byte.set()
+                    self.size += len(data)
+        except OSError as e:
+            logging.warning(f"BENCH: {self.receiver.name} kunde inte hämta {self.url}: {e}")
+            self.failed = True
+        self.first_byte.set()
+        self.done.set()
+
+
+class FakeMediaController:
+    """Mediakontrollen i en låtsasmottagare. Varje laddning (play_media eller QUEUE_LOAD) ersätter kön och
+    spelas i en egen tråd; ett spår "spelar" i track_seconds och nästa spår i kön förladdas under tiden."""
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.listeners = []
+        self.status = None
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.items = []
+        self.paused = False
+        self.resume = threading.Event()
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def fire(self, player_state, content_id=None, idle_reason=None, current_time=0.0):
+        self.status = FakeMediaStatus(player_state, content_id, idle_reason, self.generation,
+                                      self.receiver.track_seconds if content_id else None, current_time)
+        for listener in list(self.listeners):
+            listener.new_media_status(self.status)
+
+    def load(self, urls, autoplay=True):
+        with self.lock:
+            self.generation += 1
+            self.items = list(urls)
+            self.paused = not autoplay
+            self.resume.clear()
+            generation = self.generation
+        threading.Thread(target=self.run_queue, args=(generation,), daemon=True, name="FakeReceiver").start()
+
+    def play_media(self, url, content_type, stream_type='BUFFERED', metadata=None, autoplay=True, **kwargs):
+        self.receiver.record('load', url)
+        self.load([url], autoplay)
+
+    def send_message(self, msg, inc_session_id=False, callback_function=None):
+        urls = [item['media']['contentId'] for item in msg.get('items', [])]
+        if msg['type'] == 'QUEUE_LOAD':
+            self.receiver.record('load', urls[0])
+            self.load(urls)
+        elif msg['type'] == 'QUEUE_INSERT':
+            with self.lock:
+                self.items.extend(urls)
+
+    def play(self):
+        with self.lock:
+            self.paused = False
+            self.resume.set()
+        if self.status and self.status.player_state == 'PAUSED':
+            self.fire('PLAYING', self.status.content_id)
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.resume.clear()
+        if self.status: self.fire('PAUSED', self.status.content_id)
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+            self.resume.set()
+        self.fire('IDLE', self.status.content_id if self.status else None, 'CANCELLED')
+
+    def current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def run_queue(self, generation):
+        index = 0
+        prefetched = {}
+        url = None
+        while True:
+            with self.lock:
+                if generation != self.generation: return
+                if index >= len(self.items): break
+                url = self.items[index]
+                next_url = self.items[index + 1] if index + 1 < len(self.items) else None
+            fetch = prefetched.pop(url, None)
+            if fetch is None:
+                self.fire('BUFFERING', url)
+                fetch = FakeFetch(self.receiver, url)
+            fetch.first_byte.wait(30)
+            if not self.current(generation): return
+            if fetch.failed:
+                self.fire('IDLE', url, 'ERROR')
+                return
+            if self.paused:
+                self.fire('PAUSED', url)
+                self.resume.wait()
+                if not self.current(generation): return
+            self.fire('PLAYING', url)
+            self.receiver.record('playing', url)
+            if next_url and next_url not in prefetched:
+                prefetched[next_url] = FakeFetch(self.receiver, next_url)
+            played = 0.0
+            while played < self.receiver.track_seconds:
+                time.sleep(0.01)
+                if not self.current(generation): return
+                if not self.paused: played += 0.01
+            self.receiver.record('finished', url)
+            index += 1
+        if url: self.fire('IDLE', url, 'FINISHED')
+
+
+class FakeCast:
+    """Det motorn använder av pychromecast.Chromecast."""
+    def __init__(self, name, track_seconds):
+        self.name = name
+        self.track_seconds = track_seconds
+        self.cast_info = types.SimpleNamespace(
+            host='127.0.0.1', port=8009, friendly_name=name, uuid=uuid.uuid4(),
+            model_name='Fake', cast_type='audio', manufacturer='chromast_bench')
+        self.status = types.SimpleNamespace(volume_level=0.5)
+        self.socket_client = types.SimpleNamespace(is_alive=lambda: True)
+        self.media_controller = FakeMediaController(self)
+        self.events = [] # (tid, händelse, url)
+        self.events_lock = threading.Lock()
+
+    def record(self, event, url):
+        with self.events_lock:
+            self.events.append((time.perf_counter(), event, url))
+
+    def times(self, event):
+        with self.events_lock:
+            return [(t, url) for t, e, url in self.events if e == event]
+
+    def wait(self, timeout=None):
+        pass
+
+    def start(self):
+        pass
+
+    def register_connection_listener(self, listener):
+        pass
+
+    def set_volume(self, volume):
+        self.status.volume_level = volume
+
+    def disconnect(self, timeout=None):
+        pass
+
+
+# --- Mätvärden ---
+
+def percentile(values, fraction):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] # Närmaste rang
+
+
+def summarize_ms(values):
+    if not values: return None
+    return {
+        'p50': round(percentile(values, 0.50) * 1000, 2),
+        'p99': round(percentile(values, 0.99) * 1000, 2),
+        'max': round(max(values) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+def current_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None # Windows
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024 # Toppvärdet; bättre än inget
+
+
+BENCH_THREAD_PREFIXES = ('Fetcher-', 'FakeFetch', 'FakeReceiver', 'ResourceSampler')
+
+
+def engine_thread_count():
+    # Mätningens egna trådar (hämtare, låtsasmottagare) räknas inte; RSS gäller däremot hela processen
+    return sum(1 for thread in threading.enumerate() if not thread.name.startswith(BENCH_THREAD_PREFIXES))
+
+
+class ResourceSampler:
+    """Tar prov på motorns antal trådar och processens RSS medan mätningen pågår."""
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.threads_peak = 0
+        self.rss_peak = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name="ResourceSampler")
+
+    def sample(self):
+        self.threads_peak = max(self.threads_peak, engine_thread_count())
+        self.rss_peak = max(self.rss_peak, current_rss_bytes() or 0)
+
+    def run(self):
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+def resources(sampler=None):
+    rss = current_rss_bytes()
+    result = {'threads': engine_thread_count(), 'rss_mb': round(rss / 2 ** 20, 1) if rss else None}
+    if sampler:
+        result['threads_peak'] = sampler.threads_peak
+        result['rss_peak_mb'] = round(sampler.rss_peak / 2 ** 20, 1) if sampler.rss_peak else None
+    return result
+
+
+# --- Mätningar ---
+
+def bench_http(path, fetchers, requests_per_fetcher, range_bytes):
+    """N hämtare med var sin keep-alive-anslutning; varannan förfrågan hämtar hela filen, varannan ett Range-intervall."""
+    url_path = engine.register_track(path)
+    file_size = os.path.getsize(path)
+    latencies, ttfbs, errors = [], [], []
+    total_bytes = [0]
+    lock = threading.Lock()
+
+    def fetcher(worker):
+        connection = http.client.HTTPConnection('127.0.0.1', engine.PORT, timeout=30)
+        for i in range(requests_per_fetcher):
+            headers = {}
+            if i % 2:
+                start = (worker * 7919 + i * 104729) % max(1, file_size - range_bytes)
+                headers['Range'] = f"bytes={start}-{start + range_bytes - 1}"
+            started = time.perf_counter()
+            try:
+                connection.request('GET', url_path, headers=headers)
+                response = connection.getresponse()
+                first = response.read(1)
+                ttfb = time.perf_counter() - started
+                size = len(first) + len(response.read())
+                latency = time.perf_counter() - started
+                ok = response.status in (200, 206)
+            except (OSError, http.client.HTTPException) as e:
+                ok, size = False, 0
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', engine.PORT, timeout=30)
+                logging.warning(f"BENCH: HTTP-fel: {e}")
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                    ttfbs.append(ttfb)
+                    total_bytes[0] += size
+                else:
+                    errors.append(i)
+        connection.close()
+
+    threads = [threading.Thread(target=fetcher, args=(n,), name=f"Fetcher-{n}") for n in range(fetchers)]
+    started = time.perf_counter()
+    with ResourceSampler() as sampler:
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'fetchers': fetchers,
+        'requests': len(latencies) + len(errors),
+        'errors': len(errors),
+        'bytes': total_bytes[0],
+        'seconds': round(elapsed, 3),
+        'throughput_mb_s': round(total_bytes[0] / 2 ** 20 / elapsed, 1) if elapsed else None,
+        'requests_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'ttfb_ms': summarize_ms(ttfbs),
+        'latency_ms': summarize_ms(latencies),
+        'resources': resources(sampler),
+    }
+
+
+def bench_playback(cast, paths, gapless, timeout):
+    """Köar paths på cast som från GUI:t och väntar tills spellistan spelats klart."""
+    engine.set_queue_mode(gapless)
+    engine.clear(cast.name)
+    with cast.events_lock:
+        cast.events.clear()
+    now_playing = []
+    finished = threading.Event()
+
+    def listener(event, data):
+        if data.get('device') != cast.name: return
+        if event == 'now_playing' and data['filename']:
+            now_playing.append(time.perf_counter())
+        elif event == 'status' and data['text'] == "Spellistan är klar.":
+            finished.set()
+
+    engine.add_event_listener(listener)
+    try:
+        with ResourceSampler() as sampler:
+            clicked = time.perf_counter()
+            engine.queue_tracks(cast.name, paths, replace=True)
+            completed = finished.wait(timeout)
+    finally:
+        engine.event_listeners.remove(listener)
+
+    first_bytes = cast.times('first_byte')
+    playing = cast.times('playing')
+    finishes = cast.times('finished')
+    gaps = [start - end for (end, _), (start, _) in zip(finishes, playing[1:])]
+    return {
+        'gapless': gapless,
+        'tracks': len(paths),
+        'completed': completed,
+        'tracks_played': len(playing),
+        'click_to_first_byte_ms': round((first_bytes[0][0] - clicked) * 1000, 2) if first_bytes else None,
+        'click_to_playing_ms': round((playing[0][0] - clicked) * 1000, 2) if playing else None,
+        # När GUI:t visar "Nu spelas"; motorn räknar BUFFERING på rätt spår som startat
+        'click_to_now_playing_ms': round((now_playing[0] - clicked) * 1000, 2) if now_playing else None,
+        'gap_ms': summarize_ms(gaps),
+        'resources': resources(sampler),
+    }
+
+
+def bench_startup():
+    # I en ny process, eftersom modulerna redan är importerade här
+    code = ("import time\n"
+            "t0 = time.perf_counter()\nimport chromast_engine as engine\nt1 = time.perf_counter()\n"
+            "try:\n    engine.load_cast_stack()\nexcept ImportError:\n    print(t1 - t0, 'nan')\n"
+            "else:\n    print(t1 - t0, time.perf_counter() - t1)\n")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode:
+        return {'error': (result.stderr.strip().splitlines() or ["okänt fel"])[-1]}
+    engine_seconds, cast_stack_seconds = map(float, result.stdout.split())
+    return {
+        'engine_import_ms': round(engine_seconds * 1000, 2),
+        # None om pychromecast saknas
+        'cast_stack_import_ms': round(cast_stack_seconds * 1000, 2) if not math.isnan(cast_stack_seconds) else None,
+    }
+
+
+def make_tracks(directory, count, size_kb):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"spår {i:02d}.mp3")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mät chromast-motorn mot låtsasmottagare, utan nätverk och högtalare.")
+    parser.add_argument('--fetchers', type=int, default=8, help="samtidiga HTTP-hämtare")
+    parser.add_argument('--requests', type=int, default=20, help="förfrågningar per hämtare")
+    parser.add_argument('--file-mb', type=int, default=8, help="storlek på filen i HTTP-mätningen")
+    parser.add_argument('--range-kb', type=int, default=256, help="storlek på Range-förfrågningarna")
+    parser.add_argument('--tracks', type=int, default=5, help="spår i uppspelningsmätningen")
+    parser.add_argument('--track-kb', type=int, default=512, help="storlek per spår")
+    parser.add_argument('--track-seconds', type=float, default=0.5, help="hur länge låtsasmottagaren 'spelar' varje spår")
+    parser.add_argument('--port', type=int, default=engine.PORT, help="första port att prova för HTTP-servern")
+    parser.add_argument('--output', help="lägg till resultatet som en JSON-rad i den här filen")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(threadName)s - %(message)s')
+    results = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'baseline': resources(),
+        'startup': bench_startup(),
+    }
+    with tempfile.TemporaryDirectory(prefix='chromast_bench_') as directory:
+        engine.PORT = args.port
+        started = time.perf_counter()
+        if not engine.start_http_server():
+            sys.exit("Kunde inte starta HTTP-servern.")
+        results['http_server_start_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        big_file = os.path.join(directory, 'stor.mp3')
+        with open(big_file, 'wb') as f:
+            f.write(os.urandom(args.file_mb * 2 ** 20))
+        results['http'] = bench_http(big_file, args.fetchers, args.requests, args.range_kb * 1024)
+
+        cast = FakeCast('Låtsashögtalare', args.track_seconds)
+        with engine.cast_dict_lock:
+            engine.cast_dict[cast.name] = cast
+        paths = make_tracks(directory, args.tracks, args.track_kb)
+        timeout = 30 + args.tracks * (args.track_seconds + 5)
+        results['playback'] = [bench_playback(cast, paths, gapless, timeout) for gapless in (False, True)]
+        results['final'] = resources()
+        engine.shutdown()
+
+    text = json.dumps(results, ensure_ascii=False)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Kör uppspelningsmotorn utan fönster och styr den med ett lokalt JSON-API (bara 127.0.0.1).
+
+    python chromast_daemon.py [--port 8765]
+
+GET  /api/status              alla enheter och sessioner
+GET  /api/status/<enhet>      en sessions tillstånd, spellista och volym
+GET  /api/events?since=N      händelser (status, nu spelas, position, volym, enheter) efter löpnummer N
+GET  /api/traces?since=N      spår per låt (queued -> url_built -> play_media -> buffering -> playing -> idle)
+GET  /api/logs?since=N&level=WARNING   senaste loggposterna ur minnet (löpnummer efter N, lägst nivån)
+POST /api/queue   {"device", "paths", "replace"}
+POST /api/play    {"device", "index"}
+POST /api/pause   {"device"}
+POST /api/stop    {"device"}
+POST /api/clear   {"device"}
+POST /api/volume  {"device", "volume"}      volym i procent
+POST /api/group   {"device", "members"}     tom lista upplöser gruppen
+POST /api/gapless {"enabled"}
+"""
+import argparse
+import collections
+import http.server
+import itertools
+import json
+import logging
+import os
+import threading
+import urllib.parse
+
+import chromast_engine as engine
+from chromast_library import is_supported_file
+from chromast_metrics import traces
+from chromast_logging import recent_logs, setup_logging
+
+CONTROL_HOST = '127.0.0.1'
+CONTROL_PORT = 8765
+MAX_EVENTS = 200
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# Senaste händelserna för klienter som pollar /api/events; (löpnummer, händelse, data)
+events = collections.deque(maxlen=MAX_EVENTS)
+events_lock = threading.Lock()
+event_counter = itertools.count(1)
+
+
+def record_event(event, data):
+    with events_lock:
+        events.append((next(event_counter), event, data))
+
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug("API: %s - " + format, self.address_string(), *args)
+
+    def send_json(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, code, message):
+        self.send_json(code, {'error': message})
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+        if parts == ['api', 'status']:
+            self.send_json(200, engine.status())
+        elif len(parts) == 3 and parts[:2] == ['api', 'status']:
+            if parts[2] not in engine.sessions and parts[2] not in engine.device_names():
+                self.send_error_json(404, f"Okänd enhet: {parts[2]}")
+                return
+            self.send_json(200, engine.get_session(parts[2]).snapshot())
+        elif parts in (['api', 'events'], ['api', 'traces'], ['api', 'logs']):
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                since = int(query.get('since', ['0'])[0])
+            except ValueError:
+                self.send_error_json(400, "since ska vara ett heltal.")
+                return
+            if parts[1] == 'traces':
+                self.send_json(200, {'traces': traces.export(since)})
+                return
+            if parts[1] == 'logs':
+                level = logging.getLevelName(query.get('level', ['DEBUG'])[0].upper())
+                if not isinstance(level, int):
+                    self.send_error_json(400, "Okänd loggnivå.")
+                    return
+                self.send_json(200, {'logs': recent_logs.export(since, level)})
+                return
+            with events_lock:
+                selected = [{'seq': seq, 'event': event, **data} for seq, event, data in events if seq > since]
+            self.send_json(200, {'events': selected})
+        else:
+            self.send_error_json(404, "Okänd sökväg.")
+
+    def do_POST(self):
+        command = self.path.split('?')[0].rstrip('/')
+        handler = COMMANDS.get(command)
+        if handler is None:
+            self.send_error_json(404, "Okänt kommando.")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_REQUEST_BYTES:
+            self.send_error_json(400, "Ogiltig Content-Length.")
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict): raise ValueError("JSON-objekt krävs")
+        except ValueError as e:
+            self.send_error_json(400, f"Ogiltig JSON: {e}")
+            return
+        try:
+            result = handler(body)
+        except KeyError as e:
+            self.send_error_json(400, f"Fält saknas: {e.args[0]}")
+            return
+        except (TypeError, ValueError) as e:
+            self.send_error_json(400, str(e))
+            return
+        except UnknownDevice as e:
+            self.send_error_json(404, f"Okänd enhet: {e.args[0]}")
+            return
+        self.send_json(200, {'ok': True, **(result or {})})
+
+
+class UnknownDevice(Exception):
+    pass
+
+
+def known_device(body):
+    device_name = body['device']
+    if device_name not in engine.device_names(): raise UnknownDevice(device_name)
+    return device_name
+
+
+def cmd_queue(body):
+    paths = body['paths']
+    if not isinstance(paths, list): raise TypeError("paths ska vara en lista.")
+    paths = [str(p) for p in paths]
+    for path in paths:
+        # Allt som köas blir nåbart för hela nätverket via HTTP-servern: bara befintliga ljudfiler
+        if not is_supported_file(path): raise ValueError(f"Inte en ljudfil som stöds: {path}")
+        if not os.path.isfile(path): raise ValueError(f"Filen finns inte: {path}")
+    index = engine.queue_tracks(known_device(body), paths, replace=bool(body.get('replace')))
+    return {'started': index}
+
+
+def cmd_play(body):
+    return {'started': bool(engine.play_index(known_device(body), int(body['index'])))}
+
+
+def cmd_volume(body):
+    volume = float(body['volume'])
+    if not 0 <= volume <= 100: raise ValueError("volume ska vara 0-100.")
+    engine.set_volume(known_device(body), volume)
+
+
+def cmd_group(body):
+    members = body['members']
+    if not isinstance(members, list): raise TypeError("members ska vara en lista.")
+    unknown = [name for name in members if name not in engine.device_names()]
+    if unknown: raise UnknownDevice(unknown[0])
+    return {'members': engine.set_group(known_device(body), members)}
+
+
+COMMANDS = {
+    '/api/queue': cmd_queue,
+    '/api/play': cmd_play,
+    '/api/pause': lambda body: engine.pause(known_device(body)),
+    '/api/stop': lambda body: engine.stop(known_device(body)),
+    '/api/clear': lambda body: engine.clear(known_device(body)),
+    '/api/volume': cmd_volume,
+    '/api/group': cmd_group,
+    '/api/gapless': lambda body: engine.set_queue_mode(body['enabled']),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spela ljudfiler på Chromecast utan GUI, styrt via ett lokalt JSON-API.")
+    parser.add_argument('--port', type=int, default=CONTROL_PORT, help=f"port för kontroll-API:t (standard {CONTROL_PORT})")
+    parser.add_argument('--log-file', default='mp3_to_chromecast.log', help="loggfil (roteras vid 5 MB)")
+    parser.add_argument('--debug', action='store_true', help="logga även DEBUG-meddelanden")
+    args = parser.parse_args()
+
+    setup_logging(args.log_file, level=logging.DEBUG if args.debug else logging.INFO)
+    engine.add_event_listener(record_event)
+    engine.start()
+    server = http.server.ThreadingHTTPServer((CONTROL_HOST, args.port), ControlHandler)
+    server.daemon_threads = True
+    logging.info(f"API: Kontroll-API lyssnar på http://{CONTROL_HOST}:{args.port}/api/")
+    print(f"Kontroll-API: http://{CONTROL_HOST}:{args.port}/api/status")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
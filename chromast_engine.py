@@ -0,0 +1,1946 @@
+"""Uppspelningsmotorn utan Tk: HTTP-servern som strömmar filerna, enhetsupptäckt, anslutningspoolen och en
+PlayerSession per enhet. Gränssnitten (GUI:t i chromast.py, kontroll-API:t i chromast_daemon.py) styr motorn
+med funktionerna under "Kommandon" och får återkoppling som händelser via add_event_listener().
+HTTP-servern, enheternas kommandoköer och timers körs i en asyncio-loop; blockerande anrop går till
+trådpooler med fast storlek (en för pychromecast, en för HTTP-serverns disk)."""
+import os
+import sys
+import asyncio
+import mmap
+import socket
+import threading
+import collections
+import concurrent.futures
+import email.utils
+import json
+import uuid
+import secrets
+import time
+import logging
+import urllib.parse # För säker URL-hantering och kodning
+from chromast_library import MusicLibrary, LibraryWatcher
+from chromast_metadata import MetadataExtractor
+from chromast_transcode import TranscodeCache, content_type_for, served_extension, transcoder_for
+from chromast_prefetch import ReadAheadCache
+import chromast_metrics as metrics
+from chromast_metrics import traces
+
+# Globala variabler
+cast_dict = {} # enhetsnamn -> Chromecast; hålls aktuell av cast_browser, en post per enhets-UUID
+cast_dict_lock = threading.Lock()
+cast_browser = None
+DEVICE_CACHE_FILE = 'chromecast_enheter.json'
+DEVICE_CACHE_MAX_AGE = 30 * 24 * 3600 # Cachade enheter som inte svarat på 30 dagar glöms
+device_last_seen = {} # str(uuid) -> time.time() då enheten senast svarade; sparas i enhetscachen
+devices_seen_now = set() # str(uuid) för enheter som svarat sedan start
+http_server = None # asyncio-server i motorns loop
+http_slots = None # asyncio.Semaphore med MAX_HTTP_CONNECTIONS platser
+PORT = 8000
+local_ip_cache = {} # enhetens IP -> lokal adress på vägen dit
+network_interfaces = None # Senast sedda uppsättning gränssnitt/adresser
+TRACK_URL_PREFIX = "/t/"
+served_tracks = {} # token -> absolut sökväg för varje köad fil
+track_tokens = {} # absolut sökväg -> token
+served_tracks_lock = threading.Lock()
+
+# En PlayerSession per enhet med egen spellista och tillståndsmaskin
+STATE_IDLE, STATE_LOADING, STATE_PLAYING, STATE_PAUSED = 'IDLE', 'LOADING', 'PLAYING', 'PAUSED'
+LOAD_TIMEOUT_MS = 20000
+sessions = {} # enhetsnamn -> PlayerSession
+sessions_lock = threading.Lock()
+cast_sessions = {} # id(cast) -> PlayerSession som senast laddade något på enheten
+cast_sessions_lock = threading.Lock()
+track_metadata = {} # sökväg -> info från chromast_metadata; delas av alla sessioners spellistor
+
+# Musikbibliotek (SQLite-index över valda rotmappar)
+LIBRARY_DB_FILE = 'musikbibliotek.db'
+music_library = None
+library_watcher = None
+
+# Titel, artist och speltid läses i bakgrunden och cachas mellan körningar
+METADATA_CACHE_FILE = 'metadata_cache.db'
+metadata_extractor = None
+
+def user_cache_dir(name):
+    # Per användare: %LOCALAPPDATA% på Windows, ~/Library/Caches på macOS, annars $XDG_CACHE_HOME eller ~/.cache
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~\\AppData\\Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'chromast', name)
+
+# Omkodade filer (WAV, AIFF, WMA, ...) sparas här; äldst använda tas bort över gränsen
+TRANSCODE_CACHE_DIR = user_cache_dir('omkodat')
+TRANSCODE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+transcode_cache = None
+
+# Kommande spår läses i förväg till minnet (för bibliotek på NAS) och serveras därifrån
+READ_AHEAD_MAX_BYTES = 256 * 1024 ** 2
+PREFETCH_TRACKS = 2
+READ_AHEAD_CHECK_TIMEOUT = 1.0 # Svarar inte stat() inom tiden serveras bufferten ändå (hängd NAS)
+read_ahead = ReadAheadCache(READ_AHEAD_MAX_BYTES)
+status_listeners = {} # id(cast) -> MediaStatusListener
+status_listeners_lock = threading.Lock()
+
+# Gapless-läge: aktuellt spår plus QUEUE_WINDOW kommande ligger i enhetens egen mediakö
+queue_mode_enabled = True
+QUEUE_WINDOW = 3
+QUEUE_PRELOAD_SECONDS = 20
+device_workers = {} # enhetsnamn -> DeviceWorker
+device_workers_lock = threading.Lock()
+
+# Flerrumsuppspelning: samma spår startas samtidigt på alla enheter i sessionens grupp
+GROUP_SYNC_TIMEOUT_MS = 8000 # Medlemmar som inte buffrat inom tiden lämnas utanför starten
+
+event_listeners = [] # Anropas med (händelse, data); se emit()
+
+# pychromecast (med zeroconf och protobuf) är långsamt att importera på svaga datorer. Det importeras av
+# load_cast_stack() i motorns trådar när enhetssökningen startar, inte när modulen laddas.
+pychromecast = None
+zeroconf = None
+ifaddr = None # Följer med zeroconf; används för att upptäcka adressändringar
+cast_stack_lock = threading.Lock()
+
+# Motorns kärna: en asyncio-loop (HTTP-servern, enhetskommandon, timers) och två begränsade trådpooler för
+# blockerande anrop. Antalet trådar är detsamma oavsett antal anslutningar och kommandon.
+engine_loop = None
+engine_loop_lock = threading.Lock()
+BLOCKING_WORKERS = 16
+blocking_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="EngineWorker")
+# HTTP-serverns diskarbete (stat, open, läsning) har en egen pool: pychromecast-anrop som väntar på en enhet
+# (upp till 10 s) eller en gruppstart får inte göra att enheterna väntar på ljuddata
+DISK_WORKERS = 8
+disk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix="DiskWorker")
+
+# Mätvärden för /metrics (se chromast_metrics). Spåren per låt (traces) innehåller lokala sökvägar och visas
+# bara via daemonens /api/traces, som endast lyssnar på 127.0.0.1, inte här mot hela nätverket.
+METRICS_PATH = "/metrics"
+discovery_started = None # time.monotonic() när enhetssökningen startade
+http_requests_total = metrics.counter('chromast_http_requests_total', "HTTP-förfrågningar per statuskod", ['code'])
+http_request_seconds = metrics.histogram('chromast_http_request_seconds', "Tid från förfrågan till sista byte", ['code'])
+http_bytes_sent = metrics.counter('chromast_http_bytes_sent_total', "Skickade byte inklusive headers")
+http_connections = metrics.gauge('chromast_http_connections', "Öppna anslutningar till HTTP-servern")
+http_active_streams = metrics.gauge('chromast_http_active_streams', "Svar vars innehåll skickas just nu")
+discovery_seconds = metrics.histogram('chromast_discovery_seconds', "Tid från start av enhetssökningen tills en enhet hittades",
+                                      buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+track_load_seconds = metrics.histogram('chromast_track_load_seconds', "Tid från att ett spår köades tills enheten spelar det")
+track_gap_seconds = metrics.histogram('chromast_track_gap_seconds', "Tyst tid mellan två spår vid automatisk nästa låt (även i enhetens kö)")
+device_reconnects = metrics.counter('chromast_device_reconnects_total', "Återskapade sessioner mot enheter", ['device'])
+metrics.gauge('chromast_threads', "Antal trådar i processen", function=threading.active_count)
+metrics.gauge('chromast_devices', "Kända Cast-enheter", function=lambda: len(cast_dict))
+# Startens steg (imports, window, cast_stack, first_device, first_discovery) räknat från startup_started
+startup_started = time.monotonic() # Sätts av startskriptet till tiden innan dess egna importer
+startup_marks = {}
+cast_stack_import_seconds = None
+startup_seconds = metrics.gauge('chromast_startup_seconds', "Tid från programstart till startens steg", ['phase'])
+metrics.counter('chromast_prefetch_hits_total', "Svar som skickades ur läs-i-förväg-bufferten",
+                function=lambda: read_ahead.stats()['hits'])
+metrics.counter('chromast_prefetch_misses_total', "Svar som fick läsas från disk",
+                function=lambda: read_ahead.stats()['misses'])
+metrics.gauge('chromast_prefetch_buffer_bytes', "Byte i läs-i-förväg-bufferten",
+              function=lambda: read_ahead.stats()['buffered_bytes'])
+
+
+def parse_range_header(range_header, file_size):
+    """Tolkar en 'Range: bytes=...'-header. Returnerar (start, slut) inklusive, None för hela filen
+    eller False om intervallet inte går att uppfylla (416)."""
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    ranges = range_header[len('bytes='):].strip()
+    if ',' in ranges: return None # Flera intervall stöds inte, skicka hela filen
+    start_str, sep, end_str = ranges.partition('-')
+    if not sep: return None
+    try:
+        if start_str == '':
+            suffix_length = int(end_str)
+            if suffix_length <= 0: return False
+            start = max(0, file_size - suffix_length)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end or start >= file_size:
+        return False
+    return start, min(end, file_size - 1)
+
+
+class SharedFileMaps:
+    """Delade skrivskyddade mmap:ar per fil. När flera enheter i en grupp hämtar samma spår samtidigt läser
+    alla från samma mappning (sidcachen) i stället för var sin läs/skriv-loop mot disken. Används där
+    os.pread saknas (t.ex. Windows); annars läses varje bit direkt ur sidcachen med pread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = {} # (sökväg, storlek, mtime) -> [mmap, antal användare]
+
+    def acquire(self, entry, f):
+        # entry är FileEntry från open_entry(), alltså kontrollerad mot den öppna filen
+        key = (entry.path, entry.size, entry.mtime_ns)
+        with self.lock:
+            entry = self.maps.get(key)
+            if entry is None:
+                entry = self.maps[key] = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), 0]
+            entry[1] += 1
+        return key, entry[0]
+
+    def release(self, key):
+        with self.lock:
+            entry = self.maps[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.maps[key]
+                entry[0].close()
+
+
+USE_PREAD = hasattr(os, 'pread')
+SEND_CHUNK = 256 * 1024
+shared_file_maps = SharedFileMaps()
+
+
+HTTP_IDLE_TIMEOUT = 60 # Stäng inaktiva keep-alive-anslutningar
+HTTP_WRITE_TIMEOUT = 60 # En klient som slutat läsa får inte hålla kvar anslutningen
+MAX_HTTP_CONNECTIONS = 32 # Samtidigt betjänade anslutningar; fler väntar på en plats
+HTTP_SLOT_WAIT = 10
+HTTP_REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+                416: "Range Not Satisfiable", 501: "Not Implemented", 503: "Service Unavailable"}
+
+
+class ClientGone(Exception):
+    """Klienten stängde anslutningen eller slutade läsa; enheten avbryter ofta en ström vid seek."""
+
+
+def http_date(timestamp=None):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def parse_http_request(head):
+    """Tolkar förfrågningsraden och headers. Returnerar (metod, sökväg, version, headers) eller None."""
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        return None
+    if not version.startswith('HTTP/1.'): return None
+    headers = {}
+    for line in lines[1:]:
+        if not line: continue
+        name, sep, value = line.partition(':')
+        if not sep: return None
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+class HTTPConnection:
+    """En anslutning till HTTP-servern. Körs som en uppgift i motorns loop; skrivningar väntar in
+    writer.drain() så att en långsam enhet bromsar sin egen ström i stället för att fylla minnet."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.status_code = None # Senast skickade statuskod; används för mätvärdena
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(self.writer.drain(), HTTP_WRITE_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            raise ClientGone(e)
+
+    async def write(self, data):
+        if self.writer.is_closing(): raise ClientGone("anslutningen är stängd")
+        self.writer.write(data)
+        http_bytes_sent.inc(len(data))
+        await self.drain()
+
+    async def send_head(self, code, headers, keep_alive=True, prerendered=b""):
+        # prerendered: färdiga headerrader ur FileEntry, avslutade med CRLF
+        self.status_code = code
+        lines = [f"HTTP/1.1 {code} {HTTP_REASONS[code]}", f"Date: {http_date()}", "Server: chromast"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        if not keep_alive: lines.append("Connection: close")
+        await self.write(("\r\n".join(lines) + "\r\n").encode('latin-1') + prerendered + b"\r\n")
+
+    async def send_error(self, code, keep_alive=True):
+        body = f"{code} {HTTP_REASONS[code]}\n".encode('latin-1')
+        await self.send_head(code, [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))], keep_alive)
+        await self.write(body)
+
+    async def handle(self):
+        while True:
+            try:
+                head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), HTTP_IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            request = parse_http_request(head)
+            if request is None:
+                await self.send_error(400, keep_alive=False)
+                return
+            method, target, version, headers = request
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+            if method not in ('GET', 'HEAD'):
+                await self.send_error(501, keep_alive=False)
+                return
+            started = time.monotonic()
+            self.status_code = None
+            try:
+                if target.partition('?')[0] == METRICS_PATH:
+                    result = await self.send_text(metrics.render(), "text/plain; version=0.0.4; charset=utf-8",
+                                                  method == 'GET', keep_alive)
+                else:
+                    result = await self.serve_track(target, headers, method == 'GET', keep_alive)
+            finally:
+                if self.status_code:
+                    http_requests_total.inc(code=self.status_code)
+                    http_request_seconds.observe(time.monotonic() - started, code=self.status_code)
+            if not result or not keep_alive:
+                return
+
+    async def send_text(self, text, content_type, send_body, keep_alive):
+        body = text.encode('utf-8')
+        await self.send_head(200, [("Content-Type", content_type), ("Content-Length", str(len(body))),
+                                   ("Cache-Control", "no-store")], keep_alive)
+        if send_body: await self.write(body)
+        return True
+
+    async def serve_track(self, target, headers, send_body, keep_alive):
+        """Svarar på en förfrågan. Returnerar False om anslutningen ska stängas efteråt."""
+        file_path = resolve_track(target)
+        if not file_path:
+            await self.send_error(404, keep_alive)
+            return True
+        loop = asyncio.get_running_loop()
+        # Ett förinläst spår besvaras ur minnet utan open. Är bufferten inte kontrollerad nyligen görs först en
+        # stat() med kort tidsgräns; hinner disken (t.ex. en hängd NAS) inte svara serveras bufferten ändå.
+        buffered = read_ahead.get(file_path) if not transcoder_for(file_path) else None
+        if buffered and not buffered[2]:
+            try:
+                st = await asyncio.wait_for(loop.run_in_executor(disk_executor, os.stat, file_path),
+                                            READ_AHEAD_CHECK_TIMEOUT)
+            except asyncio.TimeoutError:
+                read_ahead.revalidate(file_path)
+            except OSError:
+                read_ahead.checked(file_path, None)
+                buffered = None
+            else:
+                if not read_ahead.checked(file_path, st): buffered = None
+        if buffered:
+            st, data, _ = buffered
+            entry = file_stats.validate(file_path, st)
+        else:
+            try:
+                # stat och start av omkodning kan blockera på disk; görs i diskpoolen
+                # HEAD startar ingen omkodning
+                kind, value = await loop.run_in_executor(disk_executor, lookup_track, file_path, send_body)
+            except OSError:
+                await self.send_error(404, keep_alive)
+                return True
+            if kind == 'job':
+                return await self.stream_transcode(value, send_body, keep_alive)
+            if kind == 'pending':
+                await self.send_head(200, [("Content-Type", content_type_for(file_path)), ("Transfer-Encoding", "chunked")], keep_alive)
+                return True
+            entry = value
+        if not_modified(entry, headers):
+            # 304 och HEAD besvaras ur cachen utan att filen öppnas
+            await self.send_head(304, [], keep_alive, entry.validator_headers)
+            return True
+        f = None
+        if send_body and not buffered:
+            try:
+                f, entry = await loop.run_in_executor(disk_executor, open_entry, entry)
+            except OSError:
+                await self.send_error(404, keep_alive)
+                return True
+        try:
+            range_header = headers.get('range')
+            if range_header and 'if-range' in headers and not if_range_matches(entry, headers['if-range']):
+                range_header = None # Filen har ändrats sedan enheten började läsa: skicka hela filen
+            byte_range = parse_range_header(range_header, entry.size)
+            if byte_range is False:
+                await self.send_head(416, [("Content-Range", f"bytes */{entry.size}"), ("Content-Length", "0")], keep_alive)
+                return True
+            if byte_range:
+                start, end = byte_range
+                code = 206
+                response_headers = [("Content-Range", f"bytes {start}-{end}/{entry.size}")]
+            else:
+                start, end = 0, entry.size - 1
+                code = 200
+                response_headers = []
+            length = end - start + 1
+            response_headers.append(("Content-Length", str(length)))
+            await self.send_head(code, response_headers, keep_alive, entry.entity_headers)
+            if send_body and length > 0:
+                http_active_streams.inc()
+                try:
+                    if buffered:
+                        complete = await self.send_view(memoryview(data), start, length)
+                    elif USE_PREAD:
+                        fd = f.fileno()
+                        complete = await self.send_file_range(lambda offset, count: os.pread(fd, count, offset), start, length)
+                    else:
+                        complete = await self.send_mapped_range(entry, f, start, length)
+                    if not complete: return False # Filen blev kortare under sändningen: Content-Length stämmer inte
+                finally:
+                    http_active_streams.dec()
+        finally:
+            if f: f.close()
+        return True
+
+    async def stream_transcode(self, job, send_body, keep_alive):
+        # Längden är okänd medan kodningen pågår: chunked transfer, inga Range-svar
+        streaming = False
+        loop = asyncio.get_running_loop()
+        try:
+            await self.send_head(200, [("Content-Type", job.transcoder.content_type), ("Transfer-Encoding", "chunked")], keep_alive)
+            if not send_body: return True
+            offset = 0
+            http_active_streams.inc()
+            streaming = True
+            progress = asyncio.Event()
+
+            def on_progress():
+                # Anropas i kodningstråden
+                try:
+                    loop.call_soon_threadsafe(progress.set)
+                except RuntimeError:
+                    pass # Loopen har stängts
+
+            job.add_listener(on_progress)
+            try:
+                f = await loop.run_in_executor(disk_executor, open, job.part_path, 'rb')
+                try:
+                    while True:
+                        progress.clear() # Före avläsningen så att ingen notifiering går förlorad
+                        size, done, failed = job.progress()
+                        if failed: return False
+                        if offset < size:
+                            data = await loop.run_in_executor(disk_executor, f.read, min(SEND_CHUNK, size - offset))
+                            if not data: return False # .part-filen är kortare än jobbet anger
+                            offset += len(data)
+                            await self.write(b"%x\r\n%b\r\n" % (len(data), data))
+                        elif done:
+                            break
+                        else:
+                            await progress.wait()
+                finally:
+                    f.close()
+            finally:
+                job.remove_listener(on_progress)
+            await self.write(b"0\r\n\r\n")
+            return True
+        finally:
+            if streaming: http_active_streams.dec()
+            # Sista läsaren flyttar den färdiga filen på plats och rensar cachen: disk, inte loopen
+            loop.run_in_executor(disk_executor, job.release)
+
+    async def send_file_range(self, read, offset, length):
+        # read(offset, count) körs i diskpoolen och nästa bit läses medan den förra skrivs: loopen väntar
+        # aldrig på disken, och en hängd NAS stoppar bara den här strömmen. Returnerar False om filen tog slut.
+        loop = asyncio.get_running_loop()
+        end = offset + length
+        pending = loop.run_in_executor(disk_executor, read, offset, min(SEND_CHUNK, length))
+        try:
+            while offset < end:
+                data = await pending
+                pending = None
+                if not data:
+                    logging.debug("HTTP Server: Filen tog slut %d byte före utlovad längd", end - offset)
+                    return False
+                offset += len(data)
+                if offset < end:
+                    pending = loop.run_in_executor(disk_executor, read, offset, min(SEND_CHUNK, end - offset))
+                await self.write(data)
+            return True
+        finally:
+            if pending is not None:
+                # Filen stängs (eller mappningen släpps) av anroparen: vänta ut läsningen som pågår
+                await asyncio.wait([pending])
+                if not pending.cancelled(): pending.exception()
+
+    async def send_mapped_range(self, entry, f, offset, length):
+        key, mapped = shared_file_maps.acquire(entry, f)
+        try:
+            # Sidfel i mappningen är diskläsningar; kopieringen görs därför i diskpoolen
+            return await self.send_file_range(lambda start, count: mapped[start:start + count], offset, length)
+        finally:
+            shared_file_maps.release(key)
+
+    async def send_view(self, view, offset, length):
+        # view är en förinläst buffert i minnet (ingen disk); vyn släpps när svaret är skickat
+        try:
+            for chunk_start in range(offset, offset + length, SEND_CHUNK):
+                await self.write(view[chunk_start:min(chunk_start + SEND_CHUNK, offset + length)])
+            return True
+        finally:
+            view.release()
+
+
+async def handle_http_connection(reader, writer):
+    connection = HTTPConnection(reader, writer)
+    try:
+        await asyncio.wait_for(http_slots.acquire(), HTTP_SLOT_WAIT)
+    except asyncio.TimeoutError:
+        logging.warning(f"HTTP Server: Alla {MAX_HTTP_CONNECTIONS} platser upptagna, avvisar {connection.peer}.")
+        try:
+            await connection.send_error(503, keep_alive=False)
+        except ClientGone:
+            pass
+        writer.close()
+        return
+    http_connections.inc()
+    try:
+        await connection.handle()
+    except ClientGone as e:
+        logging.debug("HTTP Server: Klienten %s stängde anslutningen: %s", connection.peer, e)
+    except Exception as e:
+        logging.error(f"HTTP Server: Fel i anslutning från {connection.peer}: {e}", exc_info=True)
+    finally:
+        http_connections.dec()
+        http_slots.release()
+        writer.close()
+
+
+class FileEntry:
+    """Det som behövs för att svara på en förfrågan om en fil utan att öppna den: storlek, mtime,
+    ETag och färdigformaterade headers."""
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.mtime_ns = st.st_mtime_ns
+        self.etag = f'"{self.size:x}-{self.mtime_ns:x}"'
+        self.last_modified = http_date(st.st_mtime)
+        self.validator_headers = f"ETag: {self.etag}\r\nLast-Modified: {self.last_modified}\r\n".encode('latin-1')
+        self.entity_headers = (f"Content-Type: {content_type_for(path)}\r\nAccept-Ranges: bytes\r\n".encode('latin-1')
+                               + self.validator_headers)
+
+    def matches(self, st):
+        return (self.size, self.mtime_ns) == (st.st_size, st.st_mtime_ns)
+
+
+class FileStatCache:
+    """FileEntry per serverad fil. Varje förfrågan gör en stat(); posten byggs om först när filens
+    storlek eller mtime ändrats. Äldsta posterna faller bort efter MAX_ENTRIES."""
+    MAX_ENTRIES = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # sökväg -> FileEntry
+
+    def lookup(self, path):
+        return self.validate(path, os.stat(path))
+
+    def validate(self, path, st):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry.matches(st):
+                self.entries.move_to_end(path)
+                return entry
+        entry = FileEntry(path, st)
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, path=None):
+        # Anropas av LibraryWatcher när en fil i biblioteket ändrats; nästa förfrågan bygger om posten
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
+
+
+file_stats = FileStatCache()
+
+
+def lookup_track(file_path, start_transcode=True):
+    """Körs i diskpoolen. Returnerar ('file', FileEntry), ('job', TranscodeJob) eller, om start_transcode är
+    falskt och filen inte är omkodad än, ('pending', None)."""
+    if transcode_cache and transcoder_for(file_path):
+        kind, value = transcode_cache.open(file_path, start=start_transcode)
+        if kind != 'file': return kind, value
+        file_path = value # Färdig fil i cachen; serveras som vanligt med Range/ETag
+    return 'file', file_stats.lookup(file_path)
+
+
+def open_entry(entry):
+    """Körs i diskpoolen. Öppnar filen; har den ändrats sedan stat() byggs posten om från den öppna filen."""
+    f = open(entry.path, 'rb')
+    st = os.fstat(f.fileno())
+    if not entry.matches(st):
+        entry = file_stats.validate(entry.path, st)
+    return f, entry
+
+
+def etag_list_matches(header, etag, weak):
+    if header.strip() == '*': return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if weak and candidate.startswith('W/'): candidate = candidate[2:]
+        if candidate == etag: return True
+    return False
+
+
+def not_modified(entry, headers):
+    # If-None-Match har företräde framför If-Modified-Since (RFC 9110 13.2.2)
+    if 'if-none-match' in headers:
+        return etag_list_matches(headers['if-none-match'], entry.etag, weak=True)
+    since = headers.get('if-modified-since')
+    if since:
+        try:
+            return entry.mtime <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def if_range_matches(entry, value):
+    # If-Range kräver stark jämförelse: en svag ETag matchar aldrig, ett datum måste vara exakt Last-Modified
+    value = value.strip()
+    if value.startswith('"'): return value == entry.etag
+    if value.startswith('W/'): return False
+    return value == entry.last_modified
+
+
+def resolve_track(path):
+    # Spår serveras som /t/<token>.<ext>; token slås upp i served_tracks
+    try:
+        decoded_path = urllib.parse.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        if not decoded_path.startswith(TRACK_URL_PREFIX):
+            logging.warning(f"HTTP Server: Okänd sökväg: {path}")
+            return ""
+        token = os.path.splitext(decoded_path[len(TRACK_URL_PREFIX):])[0]
+        with served_tracks_lock:
+            file_path = served_tracks.get(token)
+        if not file_path:
+            logging.warning(f"HTTP Server: Okänd token: {path}")
+            return ""
+        logging.debug("HTTP Server: Serverar fil: %s", file_path)
+        return file_path
+    except Exception as e:
+        logging.error(f"HTTP Server: Fel vid översättning av sökväg {path}: {e}", exc_info=True)
+        return ""
+
+def register_track(file_path):
+    """Registrerar en fil hos HTTP-servern och returnerar dess URL-sökväg (/t/<token>.<ext>)."""
+    abs_path = os.path.abspath(file_path)
+    with served_tracks_lock:
+        token = track_tokens.get(abs_path)
+        if token is None:
+            token = secrets.token_urlsafe(16) # Går inte att gissa; servern lyssnar mot hela nätverket
+            served_tracks[token] = abs_path
+            track_tokens[abs_path] = token
+    extension = served_extension(abs_path) # .mp3 för filer som kodas om
+    return f"{TRACK_URL_PREFIX}{token}{urllib.parse.quote(extension)}"
+
+def get_local_ip(device_host=None):
+    """Returnerar den lokala adress som ligger på vägen mot device_host. Resultatet cachas per enhet
+    tills nätverksgränssnitten ändras (se refresh_local_ip_cache)."""
+    target = device_host or "8.8.8.8"
+    IP = local_ip_cache.get(target)
+    if IP: return IP
+    logging.debug("Hämtar lokal IP mot %s", target)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # connect() på UDP skickar inga paket, den väljer bara rutt och källadress
+        s.connect((target, 8009))
+        IP = s.getsockname()[0]
+        local_ip_cache[target] = IP
+    except Exception as e:
+        logging.error(f"Kunde inte hämta lokal IP mot {target}: {e}", exc_info=True)
+        IP = "127.0.0.1"
+        emit('status', text="Varning: Kunde inte hämta lokal IP. Använder 127.0.0.1.")
+    finally:
+        s.close()
+    logging.debug("Hämtade IP %s mot %s", IP, target)
+    return IP
+
+def network_interface_snapshot():
+    if ifaddr:
+        return frozenset((adapter.name, str(ip.ip)) for adapter in ifaddr.get_adapters() for ip in adapter.ips)
+    return frozenset(socket.if_nameindex())
+
+def refresh_local_ip_cache():
+    # Anropas periodiskt från CastPool-övervakaren; tömmer cachen bara när gränssnitten faktiskt ändrats
+    global network_interfaces
+    # ifaddr följer med pychromecasts import; utan den skulle ögonblicksbilden byta form när importen är klar
+    if pychromecast is None: return
+    try:
+        snapshot = network_interface_snapshot()
+    except OSError as e:
+        logging.debug("Kunde inte läsa nätverksgränssnitt: %s", e)
+        return
+    if snapshot == network_interfaces: return
+    if network_interfaces is not None:
+        logging.info("Nätverksgränssnitten har ändrats, lokala adresser hämtas om.")
+        local_ip_cache.clear()
+    network_interfaces = snapshot
+
+def get_engine_loop():
+    """Motorns asyncio-loop. Startas vid första anropet i tråden "EngineLoop" och lever hela programmets livstid."""
+    global engine_loop
+    with engine_loop_lock:
+        if engine_loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(blocking_executor) # Även asyncios egna blockerande anrop (t.ex. getaddrinfo)
+            threading.Thread(target=loop.run_forever, daemon=True, name="EngineLoop").start()
+            engine_loop = loop
+        return engine_loop
+
+
+def run_in_loop(coro, timeout=None):
+    """Kör en korutin i motorns loop från en annan tråd och väntar på resultatet."""
+    return asyncio.run_coroutine_threadsafe(coro, get_engine_loop()).result(timeout)
+
+
+def call_later(delay, func, *args):
+    """Kör func(*args) i trådpoolen efter delay sekunder. Timern hålls av loopen, ingen tråd väntar."""
+    loop = get_engine_loop()
+    loop.call_soon_threadsafe(loop.call_later, delay, run_in_thread, func, *args)
+
+
+async def open_http_server():
+    global http_server, http_slots, PORT
+    if http_server: return True
+    http_slots = asyncio.Semaphore(MAX_HTTP_CONNECTIONS)
+    max_attempts = 20
+    current_port = PORT
+    for attempt in range(max_attempts):
+        try:
+            http_server = await asyncio.start_server(handle_http_connection, port=current_port)
+            PORT = current_port
+            logging.info(f"HTTP-server startad på port {PORT}")
+            return True
+        except OSError as e:
+            logging.warning(f"Port {current_port} misslyckades: {e}. Försöker nästa port.")
+            current_port += 1
+            if current_port > 65535: current_port = 8000
+    logging.error(f"Kunde inte starta HTTP-server efter {max_attempts} försök.")
+    return False
+
+
+async def close_http_server():
+    global http_server
+    if not http_server: return
+    http_server.close()
+    await http_server.wait_closed()
+    http_server = None
+
+
+def start_http_server():
+    # Servern startas en gång och lever hela programmets livstid; spår läggs till via register_track
+    if http_server:
+        logging.debug("HTTP-server körs redan.")
+        return True
+    if run_in_loop(open_http_server()): return True
+    emit('status', text="Kunde inte starta HTTP-server. Kontrollera brandvägg/andra program.")
+    return False
+
+def run_in_thread(target_func, *args, callback_success=None, callback_failure=None):
+    """Kör en funktion i motorns begränsade trådpool. Callbacks anropas i pooltråden; GUI:t flyttar dem själv till Tk."""
+    def wrapper():
+        thread_name = threading.current_thread().name
+        logging.debug("Tråd '%s' startad för: %s", thread_name, target_func.__name__)
+        try:
+            result = target_func(*args)
+            logging.debug("Tråd '%s' för %s slutförd med resultat: %s", thread_name, target_func.__name__, result is not None)
+            if callback_success:
+                callback_success(result)
+        except Exception as e:
+            logging.error(f"Fel i trådad funktion {target_func.__name__} (tråd '{thread_name}'): {e}", exc_info=True)
+            if callback_failure:
+                callback_failure(e)
+
+    return blocking_executor.submit(wrapper)
+
+class DeviceWorker:
+    """Kommandokön för en enhet, som en uppgift i motorns loop. Kommandon körs i tur och ordning, vanliga
+    funktioner i trådpoolen och korutinfunktioner direkt i loopen; volymändringar slås ihop (senaste vinner) och skickas högst en gång per VOLUME_MIN_INTERVAL."""
+    VOLUME_MIN_INTERVAL = 0.15
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.loop = get_engine_loop()
+        self.commands = collections.deque() # Ändras bara i loopen
+        self.pending_volume = None
+        self.last_volume_time = 0.0
+        self.wakeup = None # asyncio.Event; skapas i loopen (före 3.10 binds den till loopen där den skapas)
+        self.task = None
+
+    def submit(self, target_func, *args):
+        self.loop.call_soon_threadsafe(self.push, target_func, args)
+
+    def set_volume(self, volume_float):
+        self.loop.call_soon_threadsafe(self.push_volume, volume_float)
+
+    def push(self, target_func, args):
+        self.commands.append((target_func, args))
+        self.wake()
+
+    def push_volume(self, volume_float):
+        self.pending_volume = volume_float
+        self.wake()
+
+    def wake(self):
+        if self.wakeup is None: self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+
+    async def next_command(self):
+        while True:
+            self.wakeup.clear()
+            if self.commands:
+                return self.commands.popleft()
+            if self.pending_volume is not None:
+                wait_time = self.last_volume_time + self.VOLUME_MIN_INTERVAL - time.monotonic()
+                if wait_time <= 0:
+                    volume_float, self.pending_volume = self.pending_volume, None
+                    self.last_volume_time = time.monotonic()
+                    return _bg_adjust_volume, (self.device_name, volume_float)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self.wakeup.wait()
+
+    async def run(self):
+        while True:
+            target_func, args = await self.next_command()
+            try:
+                if asyncio.iscoroutinefunction(target_func):
+                    await target_func(*args)
+                else:
+                    await self.loop.run_in_executor(blocking_executor, target_func, *args)
+            except Exception as e:
+                logging.error(f"Fel i enhetskommando {target_func.__name__} ({self.device_name}): {e}", exc_info=True)
+
+
+def get_device_worker(device_name):
+    with device_workers_lock:
+        worker = device_workers.get(device_name)
+        if worker is None:
+            worker = device_workers[device_name] = DeviceWorker(device_name)
+        return worker
+
+
+# --- Bakgrundsfunktioner för Chromecast (körs i trådar) ---
+
+# --- Uppspelningens tillståndsmaskin (drivs av statushändelser från pychromecast) ---
+
+class MediaStatusListener:
+    """Tar emot media- och anslutningshändelser för en cast-enhet och skickar dem till sessionen som spelar på den."""
+    def __init__(self, cast):
+        self.cast = cast
+
+    def new_media_status(self, status):
+        session = cast_sessions.get(id(self.cast))
+        if session: session.on_media_status(self.cast, status)
+
+    def load_media_failed(self, queue_item_id, error_code):
+        logging.warning(f"EVT: Laddning misslyckades på {self.cast.name} (felkod {error_code}).")
+        session = cast_sessions.get(id(self.cast))
+        if session: session.on_media_status(self.cast, None, load_failed=True)
+
+    def new_connection_status(self, status):
+        session = cast_sessions.get(id(self.cast))
+        if session: session.on_connection_status(self.cast, status)
+
+
+def ensure_status_listener(cast):
+    # Lyssnare kan inte avregistreras, så varje cast-objekt får exakt en
+    with status_listeners_lock:
+        if id(cast) in status_listeners: return
+        listener = MediaStatusListener(cast)
+        status_listeners[id(cast)] = listener
+    cast.media_controller.register_status_listener(listener)
+    cast.register_connection_listener(listener)
+
+
+def claim_casts(session, casts):
+    """Kopplar enheternas händelser till session. En enhet som en annan session spelade på lämnas av den."""
+    with cast_sessions_lock:
+        previous = {cast_sessions.get(id(cast)) for cast in casts}
+        for cast in casts: cast_sessions[id(cast)] = session
+    for other in previous:
+        if other is not None and other is not session:
+            for cast in casts: other.release_cast(cast)
+
+
+def track_media_metadata(song):
+    # MusicTrackMediaMetadata (metadataType 3); taggar används när de hunnit läsas in
+    info = track_metadata.get(song)
+    metadata = {"metadataType": 3, "title": info['title'] if info else os.path.basename(song)}
+    if info and info['artist']: metadata["artist"] = info['artist']
+    if info and info['album']: metadata["albumName"] = info['album']
+    return metadata
+
+
+class PlayerSession:
+    """Uppspelningen på en enhet: egen spellista, position och tillståndsmaskin. Med en grupp leder enheten
+    de övriga medlemmarna. Sessionen drivs av statushändelser och enheternas DeviceWorker och har inga
+    egna trådar; tillståndet skyddas av self.lock."""
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.lock = threading.RLock()
+        self.playlist = PlaylistModel(track_metadata)
+        self.current_song_index = 0
+        self.current_cast = None
+        self.manual_playback_control = False
+        self.player_state = STATE_IDLE
+        self.loaded_media_url = None
+        self.loading_file_path = None
+        self.load_generation = 0 # Räknas upp för varje laddning så att gamla timeouts kan ignoreras
+        self.now_playing = None # Filnamn som visas när sessionen väljs i listan
+        # Gapless-läge: aktuellt spår plus QUEUE_WINDOW kommande ligger i enhetens egen mediakö
+        self.device_queue_urls = {} # media-URL -> index i playlist för spår som ligger i enhetens kö
+        self.device_queue_end = -1 # Sista playlist-index som skickats till enheten
+        # Flerrumsuppspelning: samma spår startas samtidigt på alla enheter i gruppen
+        self.group_members = [] # enhetsnamn med ledaren först (ändras bara från GUI-tråden); tom = ingen grupp
+        self.group_casts = [] # cast-objekt som spelar gruppens spår just nu, ledaren först
+        self.group_media_urls = {} # id(cast) -> URL som medlemmen laddat
+        self.group_ready = set() # id(cast) för medlemmar som buffrat spåret och väntar på gemensam start
+        self.trace = None # TrackTrace för spåret som laddas eller spelas
+        self.finished_at = None # time.monotonic() när förra spåret tog slut och nästa laddas automatiskt
+        self.track_end_expected = None # time.monotonic() då spåret slutar enligt senaste PLAYING-status (gapless-kön)
+
+    def device_names(self):
+        return list(self.group_members) or [self.device_name]
+
+    def snapshot(self):
+        """Sessionens tillstånd som ett JSON-vänligt dict (för kontroll-API:t)."""
+        cast = cast_dict.get(self.device_name)
+        volume_level = cast.status.volume_level if cast and cast.status else None
+        with self.lock:
+            return {
+                'device': self.device_name,
+                'state': self.player_state,
+                'index': self.current_song_index,
+                'now_playing': self.now_playing,
+                'playlist': list(self.playlist),
+                'group': list(self.group_members),
+                'volume': int(volume_level * 100) if volume_level is not None else None,
+            }
+
+    # --- Återkoppling till gränssnittet ---
+
+    def show_status(self, text):
+        emit('status', device=self.device_name, text=text)
+
+    def show_now_playing(self, filename):
+        self.now_playing = filename
+        emit('now_playing', device=self.device_name, filename=filename)
+
+    def refresh_view(self):
+        emit('position', device=self.device_name, index=self.current_song_index)
+
+    # --- Kommandon ---
+
+    def replace(self, paths):
+        with self.lock:
+            self.playlist.replace(paths)
+            self.current_song_index = 0
+
+    def enqueue(self, paths):
+        """Lägger till paths sist i spellistan. Returnerar index att börja spela på, eller None om något redan spelas."""
+        with self.lock:
+            start_index = len(self.playlist)
+            self.playlist.extend(paths)
+            if self.current_cast is not None: return None
+            self.current_song_index = start_index
+            return start_index
+
+    def play(self, index):
+        with self.lock:
+            if not (0 <= index < len(self.playlist)): return False
+            self.current_song_index = index
+            self.finished_at = None # Valt av användaren; inget glapp att mäta
+            self.track_end_expected = None
+            file_path = self.playlist[index]
+        self.submit_load(file_path)
+        return True
+
+    def submit_load(self, file_path):
+        # Gruppen laddas från ledarens kommandokö; medlemmarnas egna köer laddar sedan parallellt
+        device_names = self.device_names()
+        trace = traces.start(self.device_name, file_path, 'group' if len(device_names) > 1 else 'load')
+        trace.mark('queued')
+        if len(device_names) > 1:
+            get_device_worker(self.device_name).submit(self.load_group, file_path, device_names, trace)
+        else:
+            get_device_worker(self.device_name).submit(self._bg_load, file_path, trace)
+
+    def set_volume(self, volume_float):
+        for device_name in self.device_names(): # Gruppvolym: samma nivå på alla medlemmar
+            get_device_worker(device_name).set_volume(volume_float)
+
+    def pause(self):
+        device_names = self.device_names()
+        leader = cast_dict.get(self.device_name)
+        leader_status = leader.media_controller.status if leader and len(device_names) > 1 else None
+        resume = leader_status.player_state == 'PAUSED' if leader_status else None
+        for device_name in device_names:
+            get_device_worker(device_name).submit(self._bg_pause_device, device_name, resume)
+
+    def stop(self):
+        for device_name in self.device_names():
+            get_device_worker(device_name).submit(self._bg_stop_device, device_name)
+
+    def clear(self):
+        with self.lock:
+            playing = self.current_cast is not None
+        if playing: self.stop()
+        with self.lock:
+            self.playlist.clear()
+            self.current_song_index = 0
+            self.current_cast = None
+            self.manual_playback_control = False
+        self.show_now_playing(None)
+
+    # --- Laddning (körs i trådpoolen via enheternas kommandoköer) ---
+
+    def _bg_load(self, file_path, trace):
+        logging.debug("BG: Förbereder cast av %s till %s", file_path, self.device_name)
+        cast = cast_pool.get_ready(self.device_name)
+        if not cast:
+            logging.error(f"BG: Högtalare '{self.device_name}' hittades inte eller svarar inte.")
+            self.show_status(f"Fel: Högtalare '{self.device_name}' hittades inte eller svarar inte.")
+            emit_devices() # Låt gränssnittet uppdatera listan
+            return False
+
+        filename = os.path.basename(file_path)
+
+        if not http_server:
+            logging.error("BG: HTTP-servern körs inte.")
+            self.show_status("Fel: HTTP-servern körs inte.")
+            return False
+
+        ip = get_local_ip(cast.cast_info.host)
+        media_url = f"http://{ip}:{PORT}{register_track(file_path)}"
+        trace.mark('url_built')
+        logging.info(f"BG: Försöker spela URL: {media_url}")
+
+        ensure_status_listener(cast)
+        claim_casts(self, [cast])
+        with self.lock:
+            self.load_generation += 1
+            generation = self.load_generation
+            self.current_cast = cast
+            self.manual_playback_control = False
+            self.player_state = STATE_LOADING
+            self.loaded_media_url = media_url
+            self.loading_file_path = file_path
+            self.device_queue_urls.clear()
+            self.device_queue_end = -1
+            self.group_casts.clear()
+            self.end_trace('REPLACED')
+            self.trace = trace
+            use_queue = queue_mode_enabled and 0 <= self.current_song_index < len(self.playlist) \
+                and self.playlist[self.current_song_index] == file_path
+            queue_start = self.current_song_index
+        mc = cast.media_controller
+        self.show_status(f"Laddar: {filename}")
+        trace.mark('play_media', queue=use_queue)
+        if use_queue:
+            self.load_device_queue(mc, ip, queue_start)
+        else:
+            mc.play_media(media_url, content_type_for(file_path), stream_type='BUFFERED',
+                          metadata=track_media_metadata(file_path))
+        # Resten sker i on_media_status; enhetens kommandokö är fri för volym/paus under laddningen
+        call_later(LOAD_TIMEOUT_MS / 1000, self.check_load_timeout, generation, filename)
+        return True
+
+    async def load_group(self, file_path, device_names, trace):
+        # Körs i loopen: medlemmarna ansluts parallellt i trådpoolen, som är lika stor oavsett gruppens storlek
+        loop = asyncio.get_running_loop()
+        ready = await asyncio.gather(*(loop.run_in_executor(blocking_executor, cast_pool.get_ready, device_name)
+                                       for device_name in device_names))
+        await loop.run_in_executor(blocking_executor, self._bg_load_group, file_path, device_names,
+                                   [cast for cast in ready if cast], trace)
+
+    def _bg_load_group(self, file_path, device_names, casts, trace):
+        # Alla medlemmar laddar spåret pausat (autoplay av); när alla buffrat startas de med PLAY i samma ögonblick.
+        # Enhetens egen kö används inte i grupp, ledaren går vidare spår för spår och tar med sig gruppen.
+        if not casts:
+            self.show_status("Fel: Ingen av gruppens högtalare svarar.")
+            return False
+        missing = set(device_names) - {cast.name for cast in casts}
+        if missing: logging.warning(f"BG: Gruppmedlemmar som inte svarar: {', '.join(sorted(missing))}")
+        if not http_server:
+            self.show_status("Fel: HTTP-servern körs inte.")
+            return False
+
+        filename = os.path.basename(file_path)
+        track_path = register_track(file_path)
+        urls = {id(cast): f"http://{get_local_ip(cast.cast_info.host)}:{PORT}{track_path}" for cast in casts}
+        trace.mark('url_built', devices=[cast.name for cast in casts])
+        for cast in casts: ensure_status_listener(cast)
+        claim_casts(self, casts)
+        with self.lock:
+            self.load_generation += 1
+            generation = self.load_generation
+            self.current_cast = casts[0]
+            self.manual_playback_control = False
+            self.player_state = STATE_LOADING
+            self.loaded_media_url = urls[id(casts[0])]
+            self.loading_file_path = file_path
+            self.device_queue_urls.clear()
+            self.device_queue_end = -1
+            self.group_casts[:] = casts
+            self.group_media_urls = urls
+            self.group_ready.clear()
+            self.end_trace('REPLACED')
+            self.trace = trace
+        logging.info(f"BG: Laddar {filename} på gruppen {', '.join(cast.name for cast in casts)}.")
+        self.show_status(f"Laddar: {filename} på {len(casts)} högtalare")
+        trace.mark('play_media')
+        for cast in casts:
+            get_device_worker(cast.name).submit(_bg_load_group_member, cast, urls[id(cast)], file_path)
+        call_later(GROUP_SYNC_TIMEOUT_MS / 1000, self.check_group_sync, generation)
+        call_later(LOAD_TIMEOUT_MS / 1000, self.check_load_timeout, generation, filename)
+        return True
+
+    # --- Händelser (körs i pychromecasts sockettrådar: får inte blockera) ---
+
+    def on_media_status(self, cast, status, load_failed=False):
+        with self.lock:
+            if cast is not self.current_cast:
+                if self.player_state == STATE_LOADING and cast in self.group_casts:
+                    self.on_group_member_status(cast, status, load_failed)
+                return
+            self.trace_status(status, load_failed)
+            device_state = status.player_state if status else None
+            logging.debug("EVT: %s: %s <- %s (%s)", self.device_name, self.player_state, device_state, status.idle_reason if status else 'laddfel')
+
+            if self.player_state == STATE_LOADING:
+                if load_failed or (device_state == 'IDLE' and status.idle_reason == 'ERROR'):
+                    self.player_state = STATE_IDLE
+                    self.current_cast = None
+                    self.show_status(f"Fel: Kunde inte spela {os.path.basename(self.loading_file_path)}.")
+                elif len(self.group_casts) > 1:
+                    # I grupp är ledaren redo först när den buffrat klart, precis som medlemmarna (PAUSED/PLAYING)
+                    if device_state in ('PLAYING', 'PAUSED') and status.content_id == self.loaded_media_url:
+                        self.mark_group_member_ready(cast)
+                elif device_state in ('PLAYING', 'BUFFERING', 'PAUSED') and status.content_id == self.loaded_media_url:
+                    self.player_state = STATE_PAUSED if device_state == 'PAUSED' else STATE_PLAYING
+                    self.on_track_started(cast)
+                return
+
+            if self.player_state in (STATE_PLAYING, STATE_PAUSED):
+                if device_state in ('PLAYING', 'BUFFERING', 'PAUSED') and status.content_id != self.loaded_media_url \
+                        and status.content_id in self.device_queue_urls:
+                    self.on_queue_item_changed(cast, self.device_queue_urls[status.content_id], status.content_id, device_state)
+                if device_state in ('PLAYING', 'BUFFERING'):
+                    self.player_state = STATE_PLAYING
+                elif device_state == 'PAUSED':
+                    self.player_state = STATE_PAUSED
+                elif device_state == 'IDLE' and status.idle_reason in ('FINISHED', 'ERROR'):
+                    if status.idle_reason == 'FINISHED' and self.current_song_index < self.device_queue_end:
+                        self.finished_at = time.monotonic()
+                        return # Enheten går vidare i sin egen kö
+                    self.player_state = STATE_IDLE
+                    if not self.manual_playback_control:
+                        self.advance_to_next_track()
+
+    def on_connection_status(self, cast, status):
+        if status.status not in ('LOST', 'FAILED', 'DISCONNECTED'): return
+        with self.lock:
+            if cast in self.group_casts and cast is not self.current_cast:
+                logging.warning(f"EVT: Gruppmedlemmen {cast.name} kopplades ifrån ({status.status}).")
+                self.remove_group_member(cast)
+                return
+            if cast is not self.current_cast: return
+            logging.warning(f"EVT: {self.device_name} kopplades ifrån ({status.status}).")
+            self.end_trace(status.status)
+            self.player_state = STATE_IDLE
+            self.current_cast = None
+        self.show_status("Chromecast kopplades ifrån.")
+        self.show_now_playing(None)
+
+    def release_cast(self, cast):
+        # En annan session har tagit över enheten
+        with self.lock:
+            if cast in self.group_casts and cast is not self.current_cast:
+                self.remove_group_member(cast)
+                return
+            if cast is not self.current_cast: return
+            logging.info(f"EVT: {cast.name} togs över av en annan session.")
+            self.end_trace('RELEASED')
+            self.player_state = STATE_IDLE
+            self.current_cast = None
+            self.group_casts.clear()
+        self.show_now_playing(None)
+
+    def on_track_started(self, cast):
+        # Anropas med self.lock tagen när enheten börjat spela det laddade spåret
+        self.prefetch_upcoming()
+        filename = os.path.basename(self.loading_file_path)
+        if self.player_state == STATE_PAUSED:
+            get_device_worker(cast.name).submit(cast.media_controller.play)
+        self.show_status(f"Spelar: {filename}")
+        self.show_now_playing(filename)
+        report_volume(cast)
+        self.refresh_view()
+        logging.info(f"EVT: Uppspelning av {filename} startad på {self.device_name}.")
+
+    def on_queue_item_changed(self, cast, index, media_url, device_state):
+        # Anropas med self.lock tagen när enheten själv gått vidare till nästa spår i kön
+        if not (0 <= index < len(self.playlist)): return
+        self.current_song_index = index
+        self.loaded_media_url = media_url
+        filename = os.path.basename(self.playlist[index])
+        logging.info(f"EVT: {self.device_name} bytte till köat spår {index}: {filename}")
+        if self.finished_at is None and self.track_end_expected is not None:
+            # Utan IDLE mellan köade spår räknas glappet från då förra spåret skulle ta slut
+            self.finished_at = min(self.track_end_expected, time.monotonic())
+        self.track_end_expected = None
+        self.end_trace('FINISHED')
+        self.trace = traces.start(self.device_name, self.playlist[index], 'device_queue')
+        if device_state == 'PLAYING': self.trace_playing(self.trace) # Annars vid enhetens PLAYING
+        self.prefetch_upcoming()
+        self.show_status(f"Spelar: {filename}")
+        self.show_now_playing(filename)
+        self.refresh_view()
+        get_device_worker(cast.name).submit(self._bg_fill_device_queue, cast)
+
+    def advance_to_next_track(self):
+        # Anropas med self.lock tagen
+        if self.playlist and self.current_song_index < len(self.playlist) - 1:
+            logging.info(f"EVT: Nästa låt på {self.device_name}.")
+            self.finished_at = time.monotonic()
+            self.current_song_index += 1
+            self.submit_load(self.playlist[self.current_song_index])
+        else:
+            logging.info(f"EVT: Spellistan klar på {self.device_name}.")
+            self.current_cast = None
+            self.show_status("Spellistan är klar.")
+            self.show_now_playing(None)
+            self.refresh_view() # Rensa markering
+
+    def check_load_timeout(self, generation, filename):
+        with self.lock:
+            if generation != self.load_generation or self.player_state != STATE_LOADING: return
+            logging.warning(f"Timeout vid laddning av {filename} på {self.device_name}")
+            self.end_trace('TIMEOUT')
+            self.player_state = STATE_IDLE
+            self.current_cast = None
+        self.show_status(f"Fel: Timeout vid uppspelning av {filename}.")
+
+    # --- Spårning (chromast_metrics) ---
+
+    def trace_status(self, status, load_failed):
+        # Anropas med self.lock tagen för händelser från sessionens aktuella enhet
+        trace = self.trace
+        if trace is None: return
+        if load_failed:
+            trace.mark('idle', idle_reason='LOAD_FAILED')
+        elif status.content_id == self.loaded_media_url:
+            if status.player_state == 'BUFFERING':
+                trace.mark('buffering')
+            elif status.player_state == 'PLAYING':
+                self.trace_playing(trace)
+                if status.duration:
+                    self.track_end_expected = time.monotonic() + max(0.0, status.duration - status.adjusted_current_time)
+            elif status.player_state == 'IDLE':
+                trace.mark('idle', idle_reason=status.idle_reason)
+
+    def trace_playing(self, trace):
+        offset = trace.mark('playing')
+        if offset is None: return
+        if trace.offset('queued') is not None: track_load_seconds.observe(offset)
+        if self.finished_at is not None:
+            track_gap_seconds.observe(time.monotonic() - self.finished_at)
+            self.finished_at = None
+
+    def end_trace(self, reason):
+        if self.trace: self.trace.mark('idle', idle_reason=reason)
+
+    def prefetch_upcoming(self):
+        # Anropas med self.lock tagen: koda om eller läs in de närmaste spåren innan enheten ber om dem
+        start = self.current_song_index + 1
+        for path in self.playlist[start:start + PREFETCH_TRACKS]:
+            if transcode_cache and transcoder_for(path):
+                run_in_thread(transcode_cache.prefetch, path)
+            else:
+                read_ahead.prefetch(path)
+
+    # --- Enhetens egen kö (gapless) ---
+
+    def build_queue_item(self, ip, index):
+        # Ett QUEUE-objekt enligt Cast media-protokollet; preloadTime låter enheten buffra nästa spår i förväg
+        song = self.playlist[index]
+        media_url = f"http://{ip}:{PORT}{register_track(song)}"
+        item = {
+            "media": {
+                "contentId": media_url,
+                "contentType": content_type_for(song),
+                "streamType": "BUFFERED",
+                "metadata": track_media_metadata(song),
+            },
+            "autoplay": True,
+            "startTime": 0,
+            "preloadTime": QUEUE_PRELOAD_SECONDS,
+        }
+        duration = self.playlist.duration(song)
+        if duration: item["media"]["duration"] = duration
+        return media_url, item
+
+    def load_device_queue(self, mc, ip, start_index):
+        """Laddar spåret start_index plus de QUEUE_WINDOW följande i enhetens mediakö. Returnerar första spårets URL."""
+        with self.lock:
+            end_index = min(len(self.playlist) - 1, start_index + QUEUE_WINDOW)
+            entries = [self.build_queue_item(ip, i) for i in range(start_index, end_index + 1)]
+            self.device_queue_urls = {media_url: start_index + offset for offset, (media_url, _) in enumerate(entries)}
+            self.device_queue_end = end_index
+        mc.send_message({
+            "type": "QUEUE_LOAD",
+            "items": [item for _, item in entries],
+            "startIndex": 0,
+            "repeatMode": "REPEAT_OFF",
+        }, inc_session_id=True)
+        logging.info(f"BG: Köade spår {start_index}-{end_index} på {self.device_name}.")
+        return entries[0][0]
+
+    def _bg_fill_device_queue(self, cast):
+        # Håller enhetens kö QUEUE_WINDOW spår före det som spelas
+        ip = get_local_ip(cast.cast_info.host)
+        with self.lock:
+            if cast is not self.current_cast or not self.device_queue_urls: return
+            end_index = min(len(self.playlist) - 1, self.current_song_index + QUEUE_WINDOW)
+            first_new = self.device_queue_end + 1
+            entries = [self.build_queue_item(ip, i) for i in range(first_new, end_index + 1)]
+            for offset, (media_url, _) in enumerate(entries):
+                self.device_queue_urls[media_url] = first_new + offset
+            self.device_queue_end = max(self.device_queue_end, end_index)
+        if not entries: return
+        mc = cast.media_controller
+        mc.send_message({
+            "type": "QUEUE_INSERT",
+            "mediaSessionId": mc.status.media_session_id,
+            "items": [item for _, item in entries],
+        }, inc_session_id=True)
+        logging.debug("BG: Fyllde på kön på %s med spår %s-%s.", self.device_name, first_new, end_index)
+
+    # --- Grupp ---
+
+    def on_group_member_status(self, cast, status, load_failed):
+        # Anropas med self.lock tagen för gruppmedlemmar (inte ledaren) medan gruppen laddar
+        if load_failed or (status.player_state == 'IDLE' and status.idle_reason == 'ERROR'):
+            logging.warning(f"EVT: {cast.name} kunde inte ladda gruppens spår.")
+            self.remove_group_member(cast)
+        elif status.player_state in ('PAUSED', 'PLAYING') and status.content_id == self.group_media_urls.get(id(cast)):
+            self.mark_group_member_ready(cast)
+
+    def mark_group_member_ready(self, cast):
+        self.group_ready.add(id(cast))
+        if len(self.group_ready) == len(self.group_casts): self.start_group_playback()
+
+    def remove_group_member(self, cast):
+        # Anropas med self.lock tagen; gruppen fortsätter utan medlemmen
+        if cast not in self.group_casts: return
+        self.group_casts.remove(cast)
+        self.group_ready.discard(id(cast))
+        if self.player_state == STATE_LOADING and self.group_casts and len(self.group_ready) == len(self.group_casts):
+            self.start_group_playback()
+
+    def check_group_sync(self, generation):
+        # Starta med de medlemmar som hunnit buffra om ledaren är redo; resten lämnas utanför
+        with self.lock:
+            if generation != self.load_generation or self.player_state != STATE_LOADING: return
+            if id(self.current_cast) not in self.group_ready: return # Ledaren själv omfattas av check_load_timeout
+            late = [cast for cast in self.group_casts if id(cast) not in self.group_ready]
+            logging.warning(f"Gruppmedlemmar som inte hann buffra: {', '.join(cast.name for cast in late)}")
+            for cast in late: self.remove_group_member(cast)
+
+    def start_group_playback(self):
+        # Anropas med self.lock tagen när alla medlemmar buffrat spåret
+        self.player_state = STATE_PLAYING
+        casts = list(self.group_casts)
+        get_engine_loop().call_soon_threadsafe(play_group, casts)
+        logging.info(f"EVT: Startar gruppen ({len(casts)} högtalare) samtidigt.")
+        self.on_track_started(self.current_cast)
+
+    # --- Transport (körs i trådpoolen via enheternas kommandoköer) ---
+
+    def _bg_pause_device(self, device_name, resume=None):
+        # resume=None växlar efter enhetens eget läge; i en grupp bestämmer ledarens läge åt alla medlemmar
+        cast = cast_pool.get_ready(device_name)
+        if not cast: return
+        mc = cast.media_controller
+        device_state = mc.status.player_state if mc.status else None
+        if resume is None: resume = device_state == 'PAUSED'
+        if not resume and device_state == 'PLAYING':
+            mc.pause()
+            with self.lock: self.manual_playback_control = True
+            self.show_status("Uppspelning pausad.")
+        elif resume and device_state == 'PAUSED':
+            mc.play()
+            with self.lock: self.manual_playback_control = False # Spelar nu, automatisk nästa låt kan ske
+            self.show_status("Uppspelning återupptagen.")
+
+    def _bg_stop_device(self, device_name):
+        cast = cast_pool.get_ready(device_name)
+        if not cast: return
+        with self.lock: self.manual_playback_control = True
+        cast.media_controller.stop()
+        self.show_status("Uppspelning stoppad.")
+        self.show_now_playing(None)
+        with self.lock:
+            if self.current_cast is cast: self.current_cast = None
+
+
+def get_session(device_name):
+    with sessions_lock:
+        session = sessions.get(device_name)
+        if session is None:
+            session = sessions[device_name] = PlayerSession(device_name)
+        return session
+
+
+def _bg_load_group_member(cast, media_url, file_path):
+    cast.media_controller.play_media(media_url, content_type_for(file_path), stream_type='BUFFERED',
+                                     metadata=track_media_metadata(file_path), autoplay=False)
+
+
+def play_group(casts):
+    # Körs i loopen: alla PLAY-kommandon skickas direkt efter varandra. play() lägger bara meddelandet på
+    # enhetens uttag och väntar inte på svar, så ingen pooltråd behöver hållas kvar för att synka starten.
+    for cast in casts:
+        try:
+            cast.media_controller.play()
+        except Exception as e:
+            logging.error(f"BG: Kunde inte starta {cast.name} i gruppen: {e}", exc_info=True)
+
+
+def _bg_adjust_volume(selected_device_name, volume_float):
+    cast = cast_pool.get_ready(selected_device_name)
+    if not cast:
+        logging.error(f"BG_VOL: Högtalare '{selected_device_name}' hittades inte eller svarar inte.")
+        emit('status', device=selected_device_name, text="Vald högtalare hittades inte eller svarar inte.")
+        return
+    new_volume = max(0.0, min(1.0, volume_float / 100.0))
+    cast.set_volume(new_volume)
+    logging.info(f"BG_VOL: Volym satt till {int(new_volume*100)}% på {selected_device_name}.")
+    report_volume(cast)
+
+
+def report_volume(cast_obj):
+    if not cast_obj or not cast_obj.status: return # Om cast_obj är None eller saknar status
+    emit('volume', device=cast_obj.name, level=cast_obj.status.volume_level)
+
+
+# --- Anslutningspool: varma sessioner mot alla kända enheter ---
+
+class CastPool:
+    """Håller en uppkopplad session mot varje enhet i cast_dict. pychromecast återansluter själv efter
+    tappade anslutningar; poolen övervakar sockettrådarna och skapar om sessioner som gett upp, med backoff."""
+    CONNECT_TRIES = 3
+    RETRY_WAIT = 2.0
+    MAX_BACKOFF = 60.0
+    HEALTH_CHECK_INTERVAL = 5.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connected = set() # enhetsnamn med aktiv anslutning
+        self.backoff = {} # enhetsnamn -> (nuvarande backoff, tidpunkt för nästa försök)
+        self.wakeup = None # asyncio.Event; skapas i monitor() så att den hör till motorns loop
+        self.monitor_future = None
+
+    def create_cast(self, cast_info, zconf=None):
+        load_cast_stack()
+        cast = pychromecast.get_chromecast_from_cast_info(
+            cast_info, zconf, tries=self.CONNECT_TRIES, retry_wait=self.RETRY_WAIT)
+        cast.register_connection_listener(PoolConnectionListener(self, cast_info.friendly_name))
+        cast.start() # Anslut direkt i bakgrunden
+        return cast
+
+    def prime(self, device_name):
+        # Vald enhet i listan: se till att den ansluter nu i stället för vid nästa hälsokontroll
+        with self.lock:
+            self.backoff.pop(device_name, None)
+        get_engine_loop().call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        if self.wakeup: self.wakeup.set() # Innan övervakaren startat finns inget att väcka
+
+    def get_ready(self, device_name, timeout=10):
+        """Returnerar en uppkopplad Chromecast för device_name, eller None om den inte finns/svarar."""
+        cast = cast_dict.get(device_name)
+        if not cast: return None
+        try:
+            cast.wait(timeout=timeout) # Omedelbar för en varm session
+        except pychromecast.error.RequestTimeout:
+            logging.warning(f"POOL: {device_name} svarade inte inom {timeout} s.")
+            self.prime(device_name)
+            return None
+        return cast
+
+    def on_connection_status(self, device_name, status):
+        if status.status == 'CONNECTED':
+            cast = cast_dict.get(device_name)
+            if cast and mark_device_seen(cast.cast_info.uuid): run_in_thread(save_device_cache)
+        with self.lock:
+            if status.status == 'CONNECTED':
+                self.connected.add(device_name)
+                self.backoff.pop(device_name, None)
+                logging.info(f"POOL: {device_name} ansluten.")
+            else:
+                self.connected.discard(device_name)
+                logging.debug("POOL: %s -> %s", device_name, status.status)
+
+    def start_monitor(self):
+        if self.monitor_future: return
+        self.monitor_future = asyncio.run_coroutine_threadsafe(self.monitor(), get_engine_loop())
+
+    async def monitor(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.HEALTH_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await loop.run_in_executor(blocking_executor, self.check_connections)
+            except Exception as e:
+                # Ett fel i en omgång får inte stoppa övervakningen för gott
+                logging.error(f"POOL: Hälsokontrollen misslyckades: {e}", exc_info=True)
+
+    def check_connections(self):
+        # Körs i trådpoolen; att skapa om en session blockerar tills anslutningen lyckats eller gett upp
+        refresh_local_ip_cache()
+        with cast_dict_lock:
+            casts = list(cast_dict.items())
+        for device_name, cast in casts:
+            if cast.socket_client.is_alive(): continue
+            try:
+                self.reconnect(device_name, cast)
+            except Exception as e:
+                logging.error(f"POOL: Återanslutning av {device_name} misslyckades: {e}", exc_info=True)
+
+    def reconnect(self, device_name, cast):
+        now = time.monotonic()
+        with self.lock:
+            delay, next_attempt = self.backoff.get(device_name, (0.0, now))
+            if now < next_attempt: return
+            delay = min(self.MAX_BACKOFF, max(self.RETRY_WAIT, delay * 2))
+            self.backoff[device_name] = (delay, now + delay)
+        logging.info(f"POOL: Sessionen mot {device_name} har avslutats, ansluter igen (nästa försök om {delay:.0f} s).")
+        device_reconnects.inc(device=device_name)
+        new_cast = self.create_cast(cast.cast_info, cast_browser.zc if cast_browser else None)
+        with cast_dict_lock:
+            if cast_dict.get(device_name) is not cast:
+                replaced = False # Enheten togs bort eller ersattes under tiden
+            else:
+                cast_dict[device_name] = new_cast
+                replaced = True
+        if not replaced: new_cast.disconnect(timeout=0)
+
+
+class PoolConnectionListener:
+    def __init__(self, pool, device_name):
+        self.pool = pool
+        self.device_name = device_name
+
+    def new_connection_status(self, status):
+        self.pool.on_connection_status(self.device_name, status)
+
+
+cast_pool = CastPool()
+
+
+# --- Enhetsupptäckt: cache på disk + kontinuerlig mDNS-bläddring ---
+
+def load_device_cache():
+    """Enheter ur cachen som svarat inom DEVICE_CACHE_MAX_AGE. Poster utan last_seen (äldre cacheformat)
+    räknas som sedda nu, så att de får en chans att svara innan de glöms."""
+    try:
+        with open(DEVICE_CACHE_FILE, encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logging.warning(f"Kunde inte läsa enhetscachen {DEVICE_CACHE_FILE}: {e}")
+        return []
+    now = time.time()
+    fresh = []
+    for e in entries:
+        if not (e.get('name') and e.get('host') and e.get('uuid')): continue
+        last_seen = e.get('last_seen') or now
+        if now - last_seen > DEVICE_CACHE_MAX_AGE:
+            logging.info(f"DISC: {e['name']} har inte svarat sedan {time.strftime('%Y-%m-%d', time.localtime(last_seen))}, tas bort ur cachen.")
+            continue
+        with cast_dict_lock:
+            device_last_seen[e['uuid']] = last_seen
+        fresh.append(e)
+    return fresh
+
+
+def mark_device_seen(device_uuid):
+    """Enheten svarade (mDNS eller anslutning). Returnerar True första gången sedan start."""
+    key = str(device_uuid)
+    with cast_dict_lock:
+        device_last_seen[key] = time.time()
+        if key in devices_seen_now: return False
+        devices_seen_now.add(key)
+        return True
+
+
+def save_device_cache():
+    # Cachade enheter som inte svarat behåller sin gamla last_seen och faller bort efter DEVICE_CACHE_MAX_AGE
+    now = time.time()
+    with cast_dict_lock:
+        entries = [{
+            'name': name,
+            'host': cast.cast_info.host,
+            'port': cast.cast_info.port,
+            'uuid': str(cast.cast_info.uuid),
+            'model_name': cast.cast_info.model_name,
+            'cast_type': cast.cast_info.cast_type,
+            'manufacturer': cast.cast_info.manufacturer,
+            'last_seen': round(device_last_seen.get(str(cast.cast_info.uuid), now)),
+        } for name, cast in cast_dict.items()]
+    entries = [e for e in entries if now - e['last_seen'] <= DEVICE_CACHE_MAX_AGE]
+    try:
+        tmp_path = DEVICE_CACHE_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, DEVICE_CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Kunde inte spara enhetscachen: {e}")
+
+
+def add_cast_device(cast_info, zconf=None):
+    """Lägger till (eller uppdaterar) en enhet i cast_dict. Enheten känns igen på sin UUID: byter den namn
+    försvinner det gamla namnet. Befintlig anslutning behålls om namn och adress är oförändrade."""
+    name = cast_info.friendly_name
+    if not name: return False
+    with cast_dict_lock:
+        old_name = next((n for n, c in cast_dict.items() if c.cast_info.uuid == cast_info.uuid), None)
+        existing = cast_dict.get(old_name) if old_name else None
+        if existing and old_name == name and \
+                (existing.cast_info.host, existing.cast_info.port) == (cast_info.host, cast_info.port):
+            return False
+        if old_name and old_name != name:
+            del cast_dict[old_name]
+        other = cast_dict.get(name) if name != old_name else None # En annan enhet med samma namn ersätts
+        cast_dict[name] = cast_pool.create_cast(cast_info, zconf)
+    get_local_ip(cast_info.host) # Fyll adresscachen innan första spåret laddas
+    if existing and old_name != name:
+        logging.info(f"DISC: {old_name} heter nu {name}.")
+    elif existing:
+        logging.info(f"DISC: {name} har ny adress {cast_info.host}:{cast_info.port}.")
+    for cast in (existing, other):
+        if cast: cast.disconnect(timeout=0)
+    return True
+
+
+def _bg_anslut_kanda_enheter(entries):
+    # Skapar cast-objekt direkt mot kända värdar från cachen, utan att vänta på mDNS
+    if entries: load_cast_stack()
+    for entry in entries:
+        try:
+            cast_info = pychromecast.models.CastInfo(
+                {pychromecast.models.HostServiceInfo(entry['host'], entry['port'])},
+                uuid.UUID(entry['uuid']), entry.get('model_name'), entry['name'],
+                entry['host'], entry['port'], entry.get('cast_type'), entry.get('manufacturer'))
+            add_cast_device(cast_info)
+        except Exception as e:
+            logging.warning(f"DISC: Kunde inte skapa cachad enhet {entry.get('name')}: {e}")
+    logging.info(f"DISC: {len(entries)} cachade enheter inlästa.")
+
+
+def on_cast_discovered(device_uuid, _service):
+    cast_info = cast_browser.devices.get(device_uuid)
+    if not cast_info: return
+    first_seen = mark_device_seen(device_uuid)
+    if add_cast_device(cast_info, cast_browser.zc):
+        logging.info(f"DISC: Hittade {cast_info.friendly_name} ({cast_info.host}).")
+        if discovery_started is not None: discovery_seconds.observe(time.monotonic() - discovery_started)
+        mark_startup('first_device')
+        mark_startup('first_discovery')
+        save_device_cache()
+        emit_devices()
+    elif first_seen:
+        save_device_cache() # Cachad enhet som svarar igen: ny last_seen
+
+
+def on_cast_removed(device_uuid, _service, cast_info):
+    with cast_dict_lock:
+        name = next((n for n, c in cast_dict.items() if c.cast_info.uuid == device_uuid), None)
+        cast = cast_dict.pop(name, None) if name else None
+    if not cast: return
+    logging.info(f"DISC: {name} försvann från nätverket.")
+    cast.disconnect(timeout=0)
+    emit_devices()
+
+
+def _bg_starta_enhetssokning(known_hosts):
+    global cast_browser
+    try:
+        load_cast_stack()
+        listener = pychromecast.discovery.SimpleCastListener(on_cast_discovered, on_cast_removed, on_cast_discovered)
+        cast_browser = pychromecast.discovery.CastBrowser(listener, zeroconf.Zeroconf(), known_hosts)
+        cast_browser.start_discovery()
+        logging.info("DISC: Kontinuerlig enhetssökning startad.")
+    except Exception as e:
+        logging.error(f"DISC: Kunde inte starta enhetssökning: {e}", exc_info=True)
+        emit('status', text="Kunde inte starta enhetssökning. Kontrollera nätverket.")
+
+
+def start_device_discovery():
+    # Visar cachade enheter direkt och låter sedan bläddraren lägga till/ta bort enheter löpande
+    global discovery_started
+    discovery_started = time.monotonic()
+    entries = load_device_cache()
+    if entries:
+        emit('devices', names=sorted(e['name'] for e in entries))
+        mark_startup('first_device')
+    run_in_thread(_bg_anslut_kanda_enheter, entries)
+    cast_pool.start_monitor()
+    run_in_thread(_bg_starta_enhetssokning, [e['host'] for e in entries])
+
+
+# --- Spellista ---
+
+class PlaylistModel:
+    """Spellistans sökvägar. Ändras under sessionens lås; vyer får inkrementella ändringar
+    ('insert', start, antal) / ('remove', start, antal) i stället för hela listan, från den tråd som ändrade."""
+    def __init__(self, metadata):
+        self.paths = []
+        self.metadata = metadata # sökväg -> info från chromast_metadata; fylls i efter hand, delas mellan listor
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.paths[index]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self, change, start, count):
+        for listener in self.listeners:
+            listener(change, start, count)
+
+    def extend(self, paths):
+        start = len(self.paths)
+        self.paths.extend(paths)
+        if len(self.paths) > start: self.notify('insert', start, len(self.paths) - start)
+
+    def clear(self):
+        count = len(self.paths)
+        self.paths = [] # Ny lista så att bakgrundstrådar som läser den gamla inte påverkas
+        if count: self.notify('remove', 0, count)
+
+    def replace(self, paths):
+        self.clear()
+        self.extend(paths)
+
+    def metadata_changed(self):
+        if self.paths: self.notify('update', 0, len(self.paths))
+
+    def duration(self, path):
+        info = self.metadata.get(path)
+        return info['duration'] if info else None
+
+    def display_name(self, index):
+        path = self.paths[index]
+        info = self.metadata.get(path)
+        if not info: return os.path.basename(path)
+        name = f"{info['artist']} – {info['title']}" if info['artist'] else info['title']
+        if info['duration']:
+            minutes, seconds = divmod(int(info['duration']), 60)
+            name += f"  ({minutes}:{seconds:02d})"
+        return name
+
+
+# --- Händelser ---
+
+def add_event_listener(listener):
+    """listener(händelse, data) anropas från motorns trådar. Händelser: 'status' (text, ev. device),
+    'now_playing' (device, filename), 'position' (device, index), 'volume' (device, level) och 'devices' (names)."""
+    event_listeners.append(listener)
+
+
+def emit(event, **data):
+    for listener in list(event_listeners):
+        try:
+            listener(event, data)
+        except Exception as e:
+            logging.error(f"Fel i händelselyssnare för {event}: {e}", exc_info=True)
+
+
+def device_names():
+    with cast_dict_lock:
+        return sorted(cast_dict)
+
+
+def emit_devices():
+    emit('devices', names=device_names())
+
+
+
+
+# --- Bibliotek och metadata ---
+
+def _bg_open_library():
+    # Att öppna indexet tar millisekunder; omskanningen läser bara filer som ändrats sedan förra körningen
+    global music_library, library_watcher
+    library = MusicLibrary(LIBRARY_DB_FILE)
+    music_library = library
+    library_watcher = LibraryWatcher(library, on_file_change=file_stats.invalidate)
+    library_watcher.start()
+    if library.roots():
+        library.rescan()
+
+
+def on_metadata_results(results):
+    # Anropas från metadata-trådens dispatcher
+    track_metadata.update(results)
+    with sessions_lock:
+        active_sessions = list(sessions.values())
+    for session in active_sessions: session.playlist.metadata_changed()
+
+
+# --- Kommandon: används av GUI:t och daemonens kontroll-API ---
+
+def queue_tracks(device_name, paths, replace=False):
+    """Lägger paths i enhetens spellista (ersätter den om replace) och startar uppspelning om inget spelas.
+    Returnerar index för spåret som startas, eller None."""
+    session = get_session(device_name)
+    if replace:
+        session.replace(paths)
+        start_index = 0 if paths else None
+    else:
+        start_index = session.enqueue(paths)
+    if metadata_extractor and paths: metadata_extractor.submit(paths)
+    if start_index is not None and start_http_server():
+        session.play(start_index)
+        return start_index
+    return None
+
+
+def play_index(device_name, index):
+    return start_http_server() and get_session(device_name).play(index)
+
+
+def pause(device_name):
+    get_session(device_name).pause()
+
+
+def stop(device_name):
+    get_session(device_name).stop()
+
+
+def clear(device_name):
+    get_session(device_name).clear()
+
+
+def set_volume(device_name, volume):
+    """volume i procent (0-100); gäller hela gruppen om sessionen har en."""
+    get_session(device_name).set_volume(float(volume))
+
+
+def set_group(device_name, other_devices):
+    """Låter other_devices spela samma spår samtidigt som device_name (som leder gruppen); tom lista upplöser gruppen."""
+    session = get_session(device_name)
+    session.group_members = [device_name] + [name for name in other_devices if name != device_name] if other_devices else []
+    for name in session.group_members: cast_pool.prime(name)
+    logging.info(f"Högtalargrupp för {device_name}: {session.group_members or 'ingen'}")
+    return list(session.group_members)
+
+
+def set_queue_mode(enabled):
+    global queue_mode_enabled
+    queue_mode_enabled = bool(enabled) # Gäller från nästa laddade spår
+    logging.info(f"Gapless-läge {'på' if queue_mode_enabled else 'av'}.")
+
+
+def status():
+    with sessions_lock:
+        active_sessions = list(sessions.values())
+    return {
+        'devices': device_names(),
+        'gapless': queue_mode_enabled,
+        'prefetch': read_ahead.stats(),
+        'startup': startup_report(),
+        'sessions': {session.device_name: session.snapshot() for session in active_sessions},
+    }
+
+
+# --- Start och avslutning ---
+
+def load_cast_stack():
+    """Importerar pychromecast och zeroconf första gången. Blockerar; anropas bara från motorns trådar."""
+    global pychromecast, zeroconf, ifaddr, cast_stack_import_seconds
+    if pychromecast is not None: return
+    with cast_stack_lock:
+        if pychromecast is not None: return
+        started = time.monotonic()
+        import zeroconf as zeroconf_module
+        import pychromecast as pychromecast_module
+        try:
+            import ifaddr as ifaddr_module
+        except ImportError:
+            ifaddr_module = None
+        ifaddr, zeroconf = ifaddr_module, zeroconf_module
+        pychromecast = pychromecast_module # Sist: andra trådar ser pychromecast först när allt är importerat
+        cast_stack_import_seconds = time.monotonic() - started
+    logging.info(f"pychromecast importerat på {cast_stack_import_seconds:.2f} s.")
+    mark_startup('cast_stack')
+
+
+def mark_startup(phase, at=None):
+    """Registrerar första gången ett startsteg nås (sekunder sedan startup_started)."""
+    if phase in startup_marks: return
+    seconds = (at if at is not None else time.monotonic()) - startup_started
+    if startup_marks.setdefault(phase, seconds) == seconds:
+        startup_seconds.set(seconds, phase=phase)
+        logging.info(f"Start: {phase} efter {seconds * 1000:.0f} ms.")
+
+
+def startup_report():
+    report = {f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in startup_marks.items()}
+    if cast_stack_import_seconds is not None:
+        report['cast_stack_import_ms'] = round(cast_stack_import_seconds * 1000, 1)
+    return report
+
+
+def start(open_library=True):
+    """Startar motorn utan att vänta på nätverket: HTTP-servern, enhetsupptäckten (cachade enheter först),
+    biblioteket och metadataläsningen."""
+    global metadata_extractor, transcode_cache
+    transcode_cache = TranscodeCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_MAX_BYTES)
+    metadata_extractor = MetadataExtractor(METADATA_CACHE_FILE, on_metadata_results)
+    start_http_server()
+    start_device_discovery()
+    if open_library: run_in_thread(_bg_open_library)
+
+
+def shutdown():
+    logging.info("Motorn stängs...")
+    if library_watcher: library_watcher.stop()
+    if http_server:
+        logging.debug("Försöker stänga HTTP-server vid avslutning...")
+        try:
+            run_in_loop(close_http_server(), timeout=5)
+            logging.info("HTTP-server stängd.")
+        except Exception as e:
+            logging.error(f"Kunde inte stänga HTTP-servern helt vid avslutning: {e}", exc_info=True)
@@ -0,0 +1,317 @@
+"""Musikbibliotek: ett SQLite-index över musikfiler under valda rotmappar, med inkrementell omskanning
+och bevakning av nya filer."""
+import os
+import sqlite3
+import threading
+import logging
+
+from chromast_metadata import read_track_info
+from chromast_transcode import AUDIO_EXTENSIONS
+
+try:
+    from watchdog.observers import Observer # Valfritt; utan watchdog bevakas mapparna genom polling
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+SUPPORTED_EXTENSIONS = AUDIO_EXTENSIONS
+RESCAN_BATCH_SIZE = 500 # Filer per transaktion vid omskanning; en commit per fil blir en fsync per fil
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration REAL,
+    search_text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_root ON tracks(root);
+CREATE INDEX IF NOT EXISTS tracks_artist ON tracks(artist, album, path);
+"""
+
+
+def is_supported_file(path):
+    return path.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def walk_music_files(directory):
+    """Går rekursivt igenom directory med os.scandir och ger (sökväg, stat) för varje musikfil."""
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file() and is_supported_file(entry.name):
+                            yield entry.path, entry.stat()
+                    except OSError as e:
+                        logging.debug("LIB: Hoppar över %s: %s", entry.path, e)
+        except OSError as e:
+            logging.warning(f"LIB: Kunde inte läsa mappen {current}: {e}")
+
+
+class MusicLibrary:
+    """SQLite-index över sökvägar, taggar, speltid och mtime. Att öppna indexet läser ingenting från
+    musikmapparna; rescan() läser bara om filer vars storlek eller mtime ändrats."""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL") # Med WAL: fsync vid checkpoint, inte vid varje commit
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def roots(self):
+        with self.lock:
+            return [row['path'] for row in self.conn.execute("SELECT path FROM roots ORDER BY path")]
+
+    def add_root(self, path):
+        path = os.path.abspath(path)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO roots(path) VALUES (?)", (path,))
+        return path
+
+    def remove_root(self, path):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM roots WHERE path = ?", (path,))
+            self.conn.execute("DELETE FROM tracks WHERE root = ?", (path,))
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def root_for(self, path):
+        for root in self.roots():
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                return root
+        return None
+
+    def store_track(self, path, root, stat_result):
+        self.store_rows([self.track_row(path, root, stat_result)])
+
+    def track_row(self, path, root, stat_result):
+        # Läser taggarna (utan lås) och returnerar raden som ska in i tracks
+        try:
+            info = read_track_info(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"LIB: Kunde inte läsa taggar från {path}: {e}")
+            info = {'title': os.path.splitext(os.path.basename(path))[0], 'artist': None, 'album': None, 'duration': None}
+        search_text = " ".join(v for v in (info['title'], info['artist'], info['album'], os.path.basename(path)) if v).lower()
+        return (path, root, stat_result.st_size, stat_result.st_mtime,
+                info['title'], info['artist'], info['album'], info['duration'], search_text)
+
+    def store_rows(self, rows):
+        # Alla rader i en transaktion
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tracks(path, root, size, mtime, title, artist, album, duration, search_text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def update_file(self, path):
+        """Indexerar (eller tar bort) en enskild fil; används av bevakningen."""
+        path = os.path.abspath(path)
+        if not is_supported_file(path): return
+        root = self.root_for(path)
+        if not root: return
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            self.remove_file(path)
+            return
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime FROM tracks WHERE path = ?", (path,)).fetchone()
+        if row and (row['size'], row['mtime']) == (stat_result.st_size, stat_result.st_mtime):
+            return
+        self.store_track(path, root, stat_result)
+
+    def remove_file(self, path):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tracks WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                              (path, escape_like(path.rstrip(os.sep) + os.sep) + '%'))
+
+    def rescan(self, progress=None):
+        """Går igenom alla rotmappar; nya och ändrade filer läses, borttagna tas bort ur indexet.
+        Returnerar (antal lästa filer, antal borttagna)."""
+        changed = removed = 0
+        batch = []
+        for root in self.roots():
+            with self.lock:
+                known = {row['path']: (row['size'], row['mtime'])
+                         for row in self.conn.execute("SELECT path, size, mtime FROM tracks WHERE root = ?", (root,))}
+            for path, stat_result in walk_music_files(root):
+                if known.pop(path, None) == (stat_result.st_size, stat_result.st_mtime):
+                    continue
+                batch.append(self.track_row(path, root, stat_result))
+                changed += 1
+                if len(batch) >= RESCAN_BATCH_SIZE:
+                    self.store_rows(batch)
+                    batch = []
+                if progress and changed % 100 == 0: progress(changed)
+            if batch:
+                self.store_rows(batch)
+                batch = []
+            if known:
+                with self.lock, self.conn:
+                    self.conn.executemany("DELETE FROM tracks WHERE path = ?", ((p,) for p in known))
+                removed += len(known)
+        logging.info(f"LIB: Omskanning klar: {changed} lästa, {removed} borttagna, {self.count()} totalt.")
+        return changed, removed
+
+    def search(self, text, limit=500):
+        """Söker i titel, artist, album och filnamn. Alla ord i text måste förekomma."""
+        words = text.lower().split()
+        query = "SELECT path, title, artist, album, duration FROM tracks"
+        params = []
+        if words:
+            query += " WHERE " + " AND ".join("search_text LIKE ? ESCAPE '\\'" for _ in words)
+            params = [f"%{escape_like(w)}%" for w in words]
+        query += " ORDER BY artist, album, path LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, params)]
+
+    def directories(self):
+        """Alla mappar som innehåller indexerade filer, plus rotmapparna; används av pollingbevakningen."""
+        with self.lock:
+            paths = [row['path'] for row in self.conn.execute("SELECT path FROM tracks")]
+        return {os.path.dirname(p) for p in paths} | set(self.roots())
+
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class WatchdogHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.library = watcher.library
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory: self.library.update_file(event.src_path)
+        self.watcher.file_changed(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory: self.library.update_file(event.src_path)
+        self.watcher.file_changed(event.src_path)
+
+    def on_deleted(self, event):
+        self.library.remove_file(os.path.abspath(event.src_path))
+        self.watcher.file_changed(event.src_path)
+
+    def on_moved(self, event):
+        self.library.remove_file(os.path.abspath(event.src_path))
+        if not event.is_directory: self.library.update_file(event.dest_path)
+        self.watcher.file_changed(event.src_path)
+        self.watcher.file_changed(event.dest_path)
+
+
+class LibraryWatcher:
+    """Håller indexet aktuellt medan programmet körs. Använder watchdog om det finns installerat,
+    annars jämförs mapparnas mtime med jämna mellanrum och bara ändrade mappar läses om. on_file_change
+    anropas med den absoluta sökvägen för varje fil som skapats, ändrats, flyttats eller tagits bort."""
+    POLL_INTERVAL = 10.0
+
+    def __init__(self, library, on_change=None, on_file_change=None):
+        self.library = library
+        self.on_change = on_change
+        self.on_file_change = on_file_change
+        self.observer = None
+        self.stop_event = threading.Event()
+        self.dir_mtimes = {}
+
+    def start(self):
+        if Observer:
+            self.observer = Observer()
+            handler = WatchdogHandler(self)
+            for root in self.library.roots():
+                self.observer.schedule(handler, root, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+            logging.info("LIB: Bevakar biblioteket med watchdog.")
+        else:
+            self.dir_mtimes = self.snapshot()
+            threading.Thread(target=self.poll, daemon=True, name="LibraryWatcher").start()
+            logging.info("LIB: Bevakar biblioteket genom polling av mappar.")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer: self.observer.stop()
+
+    def add_root(self, root):
+        if self.observer:
+            self.observer.schedule(WatchdogHandler(self), root, recursive=True)
+        else:
+            self.dir_mtimes.setdefault(root, 0)
+
+    def file_changed(self, path):
+        if self.on_file_change: self.on_file_change(os.path.abspath(path))
+
+    def snapshot(self):
+        mtimes = {}
+        for directory in self.library.directories():
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime
+            except OSError:
+                mtimes[directory] = None
+        return mtimes
+
+    def poll(self):
+        while not self.stop_event.wait(self.POLL_INTERVAL):
+            changed_dirs = []
+            for directory, old_mtime in list(self.dir_mtimes.items()):
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != old_mtime:
+                    self.dir_mtimes[directory] = mtime
+                    changed_dirs.append(directory)
+            for directory in changed_dirs:
+                self.rescan_directory(directory)
+            if changed_dirs and self.on_change: self.on_change()
+
+    def rescan_directory(self, directory):
+        # En ändrad mapps mtime betyder att filer lagts till, tagits bort eller bytt namn i just den mappen
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            self.library.remove_file(directory)
+            self.dir_mtimes.pop(directory, None)
+            return
+        present = set()
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self.dir_mtimes:
+                    # Ny undermapp: indexera den direkt och börja bevaka den
+                    for path, _ in walk_music_files(entry.path):
+                        self.library.update_file(path)
+                    self.dir_mtimes[entry.path] = os.stat(entry.path).st_mtime
+            elif is_supported_file(entry.name):
+                present.add(entry.path)
+                self.library.update_file(entry.path)
+                self.file_changed(entry.path)
+        prefix = directory.rstrip(os.sep) + os.sep
+        with self.library.lock:
+            indexed = [row['path'] for row in self.library.conn.execute(
+                "SELECT path FROM tracks WHERE path LIKE ? ESCAPE '\\'", (escape_like(prefix) + '%',))]
+        for path in indexed:
+            if os.path.dirname(path) == directory and path not in present:
+                self.library.remove_file(path)
+                self.file_changed(path)
@@ -0,0 +1,97 @@
+"""Loggning utan diskskrivning i anroparens tråd.
+
+setup_logging() kopplar rotloggern till en kö. En skrivartråd ("LogWriter") tar posterna därifrån, formaterar
+dem och skriver till loggfilen, som roteras efter storlek. De senaste posterna sparas dessutom i minnet
+(recent_logs) så att GUI:t och kontroll-API:t kan visa dem utan att läsa filen. Anropare som loggar
+med %-argument (logging.debug("... %s", x)) betalar ingenting för nivåer som är avstängda."""
+import atexit
+import collections
+import itertools
+import logging
+import logging.handlers
+import queue
+import threading
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'
+LOG_MAX_BYTES = 5 * 1024 ** 2
+LOG_BACKUP_COUNT = 3 # mp3_to_chromecast.log.1 ... .3
+RING_BUFFER_SIZE = 500
+
+listener = None
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Lägger posten i kön. Bara meddelandet slås ihop här (argumenten kan ändras efteråt); tidsstämpel,
+    format och filskrivning sker i skrivartråden."""
+    exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None # Traceback-objekt håller kvar anroparens ramar
+        return record
+
+
+class RingBufferHandler(logging.Handler):
+    """De senaste RING_BUFFER_SIZE posterna, äldst först, med löpnummer så att klienter kan hämta bara nya."""
+    def __init__(self, capacity=RING_BUFFER_SIZE):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+        self.counter = itertools.count(1)
+        self.records_lock = threading.Lock()
+
+    def emit(self, record):
+        entry = {
+            'seq': next(self.counter),
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage() + (f"\n{record.exc_text}" if record.exc_text else ""),
+        }
+        with self.records_lock:
+            self.records.append(entry)
+
+    def export(self, since=0, level=logging.NOTSET):
+        with self.records_lock:
+            return [entry for entry in self.records
+                    if entry['seq'] > since and logging.getLevelName(entry['level']) >= level]
+
+
+recent_logs = RingBufferHandler()
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """QueueListener vars tråd heter "LogWriter" (syns i trådlistor och i motorns trådräkning)."""
+    def start(self):
+        thread = threading.Thread(target=self._monitor, daemon=True, name="LogWriter")
+        self._thread = thread
+        thread.start()
+
+
+def setup_logging(log_file, level=logging.INFO, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """Ersätter rotloggerns hanterare med kön och startar skrivartråden. Kön töms och filen stängs vid avslut."""
+    global listener
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                                        encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LogQueueHandler(log_queue))
+    root.setLevel(level)
+    listener = LogWriter(log_queue, file_handler, recent_logs)
+    listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Skriver ut det som står i kön och stänger filen."""
+    global listener
+    if listener is None: return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
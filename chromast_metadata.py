@@ -0,0 +1,275 @@
+"""Läser taggar och speltid ur MP3-filer (ID3v1/ID3v2, MPEG-ramhuvuden och Xing/VBRI) utan externa beroenden,
+samt en persistent cache och en processpool för att läsa många filer parallellt."""
+import os
+import struct
+import sqlite3
+import threading
+import queue
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Bithastighet i kbit/s per (MPEG-version, index); lager III
+BITRATES_MPEG1_L3 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0]
+BITRATES_MPEG2_L3 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0]
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000], # MPEG 1
+    2: [22050, 24000, 16000], # MPEG 2
+    0: [11025, 12000, 8000], # MPEG 2.5
+}
+
+# ID3v2-ramar som används; v2.2 har tre tecken långa id:n
+TEXT_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album',
+}
+
+FRAME_SEARCH_LIMIT = 64 * 1024 # Så långt efter taggen letar vi efter första ljudramen
+
+
+def syncsafe_int(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_text_frame(data):
+    if not data: return None
+    encoding, payload = data[0], data[1:]
+    try:
+        if encoding == 0:
+            text = payload.decode('latin-1')
+        elif encoding == 1:
+            text = payload.decode('utf-16')
+        elif encoding == 2:
+            text = payload.decode('utf-16-be')
+        elif encoding == 3:
+            text = payload.decode('utf-8')
+        else:
+            return None
+    except UnicodeDecodeError:
+        return None
+    # Flera värden separeras med NUL; vi använder det första
+    text = text.split('\x00')[0].strip()
+    return text or None
+
+
+def read_id3v2(f):
+    """Returnerar (taggar, storlek på taggen i byte). Filen ska stå på position 0."""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return {}, 0
+    major, flags = header[3], header[5]
+    tag_size = syncsafe_int(header[6:10])
+    total_size = 10 + tag_size + (10 if flags & 0x10 else 0) # Sidfot i v2.4
+    data = f.read(tag_size)
+    tags = {}
+    pos = 0
+    if flags & 0x40 and major >= 3: # Utökat huvud
+        ext_size = syncsafe_int(data[0:4]) if major == 4 else struct.unpack('>I', data[0:4])[0] + 4
+        pos = ext_size
+    id_len, header_len = (3, 6) if major == 2 else (4, 10)
+    while pos + header_len <= len(data):
+        frame_id = data[pos:pos + id_len]
+        if not frame_id.strip(b'\x00'): break # Utfyllnad
+        if major == 2:
+            frame_size = int.from_bytes(data[pos + 3:pos + 6], 'big')
+        elif major == 4:
+            frame_size = syncsafe_int(data[pos + 4:pos + 8])
+        else:
+            frame_size = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        pos += header_len
+        if frame_size <= 0 or pos + frame_size > len(data): break
+        key = TEXT_FRAMES.get(frame_id.decode('latin-1', 'replace'))
+        if key and key not in tags:
+            value = decode_text_frame(data[pos:pos + frame_size])
+            if value: tags[key] = value
+        pos += frame_size
+    return tags, total_size
+
+
+def read_id3v1(f, file_size):
+    if file_size < 128: return {}
+    f.seek(file_size - 128)
+    data = f.read(128)
+    if data[:3] != b'TAG': return {}
+    tags = {}
+    for key, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93)):
+        value = data[start:end].split(b'\x00')[0].decode('latin-1').strip()
+        if value: tags[key] = value
+    return tags
+
+
+def parse_frame_header(header):
+    """Tolkar ett 4-byte MPEG lager III-ramhuvud. Returnerar (version, bithastighet bit/s, samplingsfrekvens) eller None."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = (header[2] >> 4) & 0x0F
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or sample_rate_index == 3: # Reserverat eller inte lager III
+        return None
+    table = BITRATES_MPEG1_L3 if version == 3 else BITRATES_MPEG2_L3
+    bitrate = table[bitrate_index] * 1000
+    if not bitrate: return None
+    return version, bitrate, SAMPLE_RATES[version][sample_rate_index]
+
+
+def find_first_frame(f, audio_start):
+    f.seek(audio_start)
+    data = f.read(FRAME_SEARCH_LIMIT)
+    pos = data.find(b'\xff')
+    while 0 <= pos < len(data) - 4:
+        frame = parse_frame_header(data[pos:pos + 4])
+        if frame:
+            return audio_start + pos, frame, data[pos:]
+        pos = data.find(b'\xff', pos + 1)
+    return None, None, None
+
+
+def read_vbr_frame_count(frame_data, version):
+    """Antal ramar enligt ett Xing/Info- eller VBRI-huvud i första ramen, eller None för CBR utan huvud."""
+    mono = (frame_data[3] >> 6) == 3
+    if version == 3:
+        offset = 4 + (17 if mono else 32)
+    else:
+        offset = 4 + (9 if mono else 17)
+    if frame_data[offset:offset + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', frame_data[offset + 4:offset + 8])[0]
+        if flags & 0x01:
+            return struct.unpack('>I', frame_data[offset + 8:offset + 12])[0] or None
+        return None
+    if frame_data[36:40] == b'VBRI': # Fraunhofer, alltid 32 byte efter huvudet
+        return struct.unpack('>I', frame_data[50:54])[0] or None
+    return None
+
+
+def read_track_info(path):
+    """Returnerar titel, artist, album, speltid (s) och bithastighet (kbit/s) för en ljudfil; bara MP3 tolkas.
+    Saknade värden blir None. Speltiden tas från Xing/VBRI-huvudet om det finns, annars från
+    första ramens bithastighet (CBR)."""
+    info = {'title': None, 'artist': None, 'album': None, 'duration': None, 'bitrate': None}
+    file_size = os.path.getsize(path)
+    if not path.lower().endswith('.mp3'):
+        # Andra format (FLAC, WAV, ...) tolkas inte; titeln tas från filnamnet
+        info['title'] = os.path.splitext(os.path.basename(path))[0]
+        return info
+    with open(path, 'rb') as f:
+        tags, audio_start = read_id3v2(f)
+        id3v1 = read_id3v1(f, file_size)
+        info.update(tags or id3v1)
+        frame_pos, frame, frame_data = find_first_frame(f, audio_start)
+        if frame:
+            version, bitrate, sample_rate = frame
+            audio_size = file_size - frame_pos - (128 if id3v1 else 0)
+            frame_count = read_vbr_frame_count(frame_data, version) if len(frame_data) >= 64 else None
+            if frame_count:
+                samples_per_frame = 1152 if version == 3 else 576
+                duration = frame_count * samples_per_frame / sample_rate
+                bitrate = int(audio_size * 8 / duration) if duration else bitrate
+            else:
+                duration = audio_size * 8 / bitrate
+            info['bitrate'] = bitrate // 1000
+            info['duration'] = round(duration, 2)
+    if not info['title']:
+        info['title'] = os.path.splitext(os.path.basename(path))[0]
+    return info
+
+
+def read_track_infos(paths):
+    """Körs i en arbetsprocess: läser en sats filer och returnerar [(sökväg, info eller None)]."""
+    results = []
+    for path in paths:
+        try:
+            results.append((path, read_track_info(path)))
+        except (OSError, ValueError, struct.error, IndexError):
+            results.append((path, None))
+    return results
+
+
+class MetadataCache:
+    """Persistent cache för read_track_info, nycklad på sökväg + storlek + mtime."""
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS track_info (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "title TEXT, artist TEXT, album TEXT, duration REAL, bitrate INTEGER)")
+
+    def get(self, path, size, mtime):
+        row = self.conn.execute(
+            "SELECT title, artist, album, duration, bitrate FROM track_info WHERE path = ? AND size = ? AND mtime = ?",
+            (path, size, mtime)).fetchone()
+        if row is None: return None
+        return dict(zip(('title', 'artist', 'album', 'duration', 'bitrate'), row))
+
+    def put_many(self, entries):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO track_info VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path, size, mtime, info['title'], info['artist'], info['album'], info['duration'], info['bitrate'])
+                 for path, size, mtime, info in entries])
+
+
+class MetadataExtractor:
+    """Läser metadata i bakgrunden. submit() returnerar direkt; en dispatcher-tråd slår upp cachen och
+    skickar missar i satser till en processpool. on_results anropas från dispatcher-tråden med
+    [(sökväg, info)] så fort en sats är klar."""
+    BATCH_SIZE = 25
+
+    def __init__(self, cache_path, on_results, max_workers=None):
+        self.cache_path = cache_path
+        self.on_results = on_results
+        self.max_workers = max_workers or min(8, os.cpu_count() or 2)
+        self.executor = None
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="MetadataExtractor")
+        self.thread.start()
+
+    def submit(self, paths):
+        self.pending.put(list(paths))
+
+    def get_executor(self):
+        if self.executor is None:
+            # spawn: arbetsprocesserna ska inte ärva GUI-trådar eller öppna sockets
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def run(self):
+        cache = MetadataCache(self.cache_path) # SQLite-anslutningen används bara i den här tråden
+        while True:
+            paths = self.pending.get()
+            hits, misses = [], {}
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                info = cache.get(path, st.st_size, st.st_mtime)
+                if info:
+                    hits.append((path, info))
+                else:
+                    misses[path] = (st.st_size, st.st_mtime)
+            if hits: self.on_results(hits)
+            if misses: self.extract(cache, misses)
+
+    def extract(self, cache, misses):
+        paths = list(misses)
+        batches = [paths[i:i + self.BATCH_SIZE] for i in range(0, len(paths), self.BATCH_SIZE)]
+        try:
+            executor = self.get_executor()
+            futures = [executor.submit(read_track_infos, batch) for batch in batches]
+            for future in as_completed(futures):
+                self.store(cache, misses, future.result())
+        except Exception as e:
+            # Processpoolen kan saknas (t.ex. i vissa frysta miljöer); läs då i den här tråden
+            logging.warning(f"META: Processpoolen misslyckades ({e}), läser metadata i tråd.")
+            self.executor = None
+            for batch in batches:
+                self.store(cache, misses, read_track_infos(batch))
+
+    def store(self, cache, misses, results):
+        found = [(path, info) for path, info in results if info]
+        cache.put_many([(path, *misses[path], info) for path, info in found])
+        if found: self.on_results(found)
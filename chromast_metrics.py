@@ -0,0 +1,237 @@
+"""Mätvärden i Prometheus textformat och spårning av varje låts väg från kö till uppspelning.
+
+Mätvärden registreras en gång på modulnivå (counter/gauge/histogram) och uppdateras från vilken tråd som
+helst; render() ger texten som HTTP-serverns /metrics svarar med. Spår (TrackTrace) samlar tidpunkterna
+för en låts steg (queued, url_built, play_media, buffering, playing, idle) och de senaste sparas i traces."""
+import collections
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_TRACES = 200
+
+
+def format_value(value):
+    if value == math.inf: return "+Inf"
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs: return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {} # etikettvärden -> värde
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} kräver etiketterna {self.label_names}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    """Ett värde som bara ökar. Med function läses värdet (t.ex. en räknare i en annan modul) när det hämtas."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        super().__init__(name, help_text, label_names)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        if self.function:
+            return self.header() + [f"{self.name} {format_value(self.function())}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.label_names: items = [((), 0)]
+        return self.header() + [f"{self.name}{format_labels(self.label_names, k)} {format_value(v)}" for k, v in items]
+
+
+class Gauge(Metric):
+    """Ett värde som kan gå upp och ner. Med function läses värdet först när det hämtas."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        super().__init__(name, help_text, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.function:
+            return self.header() + [f"{self.name} {format_value(self.function())}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.label_names: items = [((), 0)]
+        return self.header() + [f"{self.name}{format_labels(self.label_names, k)} {format_value(v)}" for k, v in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0] # antal per hink, summa, antal
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, key, [('le', format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+metrics = []
+metrics_lock = threading.Lock()
+
+
+def register(metric):
+    with metrics_lock:
+        metrics.append(metric)
+    return metric
+
+
+def counter(name, help_text, label_names=(), function=None):
+    return register(Counter(name, help_text, label_names, function))
+
+
+def gauge(name, help_text, label_names=(), function=None):
+    return register(Gauge(name, help_text, label_names, function))
+
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, help_text, label_names, buckets))
+
+
+def render():
+    """Alla registrerade mätvärden i Prometheus textformat (version 0.0.4)."""
+    with metrics_lock:
+        registered = list(metrics)
+    lines = []
+    for metric in registered:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Spårning per låt ---
+
+class TrackTrace:
+    """Tidpunkterna för en låts steg. Varje steg registreras en gång; spannet för ett steg varar till nästa."""
+    def __init__(self, trace_id, device_name, track, mode):
+        self.trace_id = trace_id
+        self.device_name = device_name
+        self.track = track
+        self.mode = mode
+        self.started = time.time()
+        self.started_monotonic = time.monotonic()
+        self.stages = [] # (steg, sekunder sedan start)
+        self.attributes = {}
+        self.lock = threading.Lock()
+
+    def mark(self, stage, **attributes):
+        """Registrerar steget om det inte redan finns. Returnerar sekunder sedan start, eller None om det fanns."""
+        with self.lock:
+            if any(name == stage for name, _ in self.stages): return None
+            offset = time.monotonic() - self.started_monotonic
+            self.stages.append((stage, offset))
+            self.attributes.update(attributes)
+        return offset
+
+    def offset(self, stage):
+        with self.lock:
+            return next((offset for name, offset in self.stages if name == stage), None)
+
+    def export(self):
+        with self.lock:
+            stages = list(self.stages)
+            attributes = dict(self.attributes)
+        spans = []
+        for i, (name, offset) in enumerate(stages):
+            end = stages[i + 1][1] if i + 1 < len(stages) else None
+            spans.append({
+                'name': name,
+                'start': round(self.started + offset, 6),
+                'offset_ms': round(offset * 1000, 2),
+                'duration_ms': round((end - offset) * 1000, 2) if end is not None else None,
+            })
+        return {
+            'trace_id': self.trace_id,
+            'device': self.device_name,
+            'track': self.track,
+            'mode': self.mode,
+            'started': round(self.started, 6),
+            'spans': spans,
+            **attributes,
+        }
+
+
+class TraceLog:
+    """De senaste MAX_TRACES spåren, äldst först."""
+    def __init__(self, max_traces=MAX_TRACES):
+        self.lock = threading.Lock()
+        self.traces = collections.deque(maxlen=max_traces)
+        self.next_id = 1
+
+    def start(self, device_name, track, mode='load'):
+        with self.lock:
+            trace = TrackTrace(self.next_id, device_name, track, mode)
+            self.next_id += 1
+            self.traces.append(trace)
+        return trace
+
+    def export(self, since=0):
+        with self.lock:
+            selected = [trace for trace in self.traces if trace.trace_id > since]
+        return [trace.export() for trace in selected]
+
+
+traces = TraceLog()
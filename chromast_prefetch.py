@@ -0,0 +1,161 @@
+"""Läser kommande spår i förväg, så att en långsam eller tillfälligt hängd nätverksdisk (NAS via NFS/SMB)
+inte märks när enheten börjar hämta nästa spår. Spåren läses till en minnesbuffert med fast tak och serveras
+därifrån; filer som är för stora för bufferten får i stället en läs-i-förväg-hint till operativsystemet.
+Innan en buffrad fil serveras kontrollerar anroparen med stat() att den är oförändrad (se get() och checked()),
+första gången efter inläsningen och sedan högst var REVALIDATE_INTERVAL sekund."""
+import os
+import collections
+import threading
+import time
+import logging
+
+READ_CHUNK_SIZE = 1024 * 1024
+MAX_PENDING = 8 # Äldre önskemål släpps om användaren hoppar runt i spellistan
+REVALIDATE_INTERVAL = 5.0 # Sekunder mellan kontrollerna av att en buffrad fil inte ändrats
+
+
+class ReadAheadCache:
+    """Minnesbuffert för förinlästa filer, högst max_bytes totalt (äldst använda släpps först). En fil läses
+    bara in om den är högst max_file_bytes. Nycklarna är absoluta sökvägar. prefetch() returnerar direkt;
+    läsning och kontroll sker i en egen tråd så att en hängd disk inte binder motorns trådpool."""
+    def __init__(self, max_bytes=256 * 1024 ** 2, max_file_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes or max_bytes // 4
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # sökväg -> [os.stat_result, bytearray, senast kontrollerad eller None], äldst först
+        self.total_bytes = 0
+        self.condition = threading.Condition(self.lock)
+        self.pending = collections.deque(maxlen=MAX_PENDING)
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+        self.hinted = 0
+        self.evicted = 0
+        self.failed = 0
+
+    def prefetch(self, path):
+        path = os.path.abspath(path)
+        with self.condition:
+            if path in self.entries: return
+            self.queue(path)
+
+    def queue(self, path):
+        # Anropas med self.lock tagen
+        if path not in self.pending:
+            self.pending.append(path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name="ReadAhead")
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                path = self.pending.popleft()
+            try:
+                self.load(path)
+            except OSError as e:
+                with self.lock:
+                    self.failed += 1
+                    self.drop(path) # Borttagen eller oläslig: serveras inte längre ur bufferten
+                logging.warning(f"PREFETCH: Kunde inte läsa {path} i förväg: {e}")
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry and same_file(entry[0], st):
+                    entry[2] = time.monotonic()
+                    return
+                self.drop(path) # Ändrad sedan inläsningen; läses om nedan
+            if st.st_size > self.max_file_bytes:
+                # För stor för bufferten: låt operativsystemet läsa in den i sidcachen i stället
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    with self.lock: self.hinted += 1
+                return
+            data = bytearray(st.st_size)
+            view = memoryview(data)
+            offset = 0
+            while offset < st.st_size:
+                count = f.readinto(view[offset:offset + READ_CHUNK_SIZE])
+                if not count: break
+                offset += count
+            view.release()
+            if offset != st.st_size or os.fstat(f.fileno()).st_mtime_ns != st.st_mtime_ns:
+                logging.debug("PREFETCH: %s ändrades under inläsningen, sparas inte.", path)
+                return
+        with self.lock:
+            self.drop(path)
+            self.entries[path] = [st, data, None] # Kontrolleras vid första förfrågan
+            self.total_bytes += st.st_size
+            self.loaded += 1
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (old_st, _, _) = self.entries.popitem(last=False)
+                self.total_bytes -= old_st.st_size
+                self.evicted += 1
+        logging.debug("PREFETCH: %s inläst (%s kB).", path, st.st_size // 1024)
+
+    def drop(self, path):
+        # Anropas med self.lock tagen
+        entry = self.entries.pop(path, None)
+        if entry: self.total_bytes -= entry[0].st_size
+
+    def get(self, path):
+        """(os.stat_result, innehåll, kontrollerad) för path om den finns i bufferten, annars None. Rör inte
+        disken. kontrollerad är falskt första gången efter inläsningen och när senaste kontrollen är äldre än
+        REVALIDATE_INTERVAL; anroparen gör då stat() och lämnar svaret till checked() innan bufferten används."""
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            fresh = entry[2] is not None and time.monotonic() - entry[2] <= REVALIDATE_INTERVAL
+            return entry[0], entry[1], fresh
+
+    def checked(self, path, st):
+        """Anroparens stat() av path (None om filen inte gick att nå). Returnerar True om bufferten fortfarande
+        gäller; annars släpps den, förfrågan räknas som miss och en ändrad fil köas för ny inläsning."""
+        path = os.path.abspath(path)
+        with self.condition:
+            entry = self.entries.get(path)
+            if entry and st and same_file(entry[0], st):
+                entry[2] = time.monotonic()
+                return True
+            self.drop(path)
+            self.hits -= 1
+            self.misses += 1
+            if st: self.queue(path)
+            return False
+
+    def revalidate(self, path):
+        # Anroparens stat() hann inte svara (hängd disk): kontrollen görs i stället i läs-i-förväg-tråden
+        with self.condition:
+            self.queue(os.path.abspath(path))
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 3) if requests else None,
+                'buffered_files': len(self.entries),
+                'buffered_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'loaded': self.loaded,
+                'hinted': self.hinted,
+                'evicted': self.evicted,
+                'failed': self.failed,
+            }
+
+
+def same_file(a, b):
+    return (a.st_size, a.st_mtime_ns) == (b.st_size, b.st_mtime_ns)
@@ -0,0 +1,261 @@
+"""Omkodning av ljudformat som Cast-enheter inte spelar, eller som är onödigt stora att strömma (WAV/AIFF),
+till MP3. Utdata strömmas medan kodningen pågår och sparas i en storleksbegränsad LRU-cache på disk."""
+import os
+import shutil
+import hashlib
+import subprocess
+import threading
+import collections
+import logging
+
+# Format som Cast-enheter spelar direkt; de skickas som de är, med rätt Content-Type
+NATIVE_CONTENT_TYPES = {
+    '.mp3': 'audio/mpeg',
+    '.flac': 'audio/flac',
+    '.ogg': 'audio/ogg',
+    '.oga': 'audio/ogg',
+    '.opus': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.aac': 'audio/aac',
+}
+TRANSCODED_EXTENSIONS = {'.wav', '.aif', '.aiff', '.wma', '.ape', '.wv'}
+AUDIO_EXTENSIONS = tuple(sorted(set(NATIVE_CONTENT_TYPES) | TRANSCODED_EXTENSIONS))
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class CommandTranscoder:
+    """Kodar om med ett externt program som läser källfilen ({input} i argv) och skriver resultatet till stdout."""
+    def __init__(self, name, argv, output_extension='.mp3', content_type='audio/mpeg'):
+        self.name = name
+        self.argv = argv
+        self.output_extension = output_extension
+        self.content_type = content_type
+        self.available = None
+
+    def is_available(self):
+        if self.available is None: # Slås upp en gång; undviker en PATH-sökning per förfrågan
+            self.available = shutil.which(self.argv[0]) is not None
+            if not self.available:
+                logging.warning(f"TRANSCODE: {self.argv[0]} saknas, {self.name} är inte tillgänglig.")
+        return self.available
+
+    def start(self, source_path):
+        argv = [arg.replace('{input}', source_path) for arg in self.argv]
+        return subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+FFMPEG_MP3 = CommandTranscoder('ffmpeg-mp3-192k', [
+    'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', '{input}', '-vn', '-map_metadata', '-1',
+    '-f', 'mp3', '-codec:a', 'libmp3lame', '-b:a', '192k', 'pipe:1'])
+
+transcoders = {extension: FFMPEG_MP3 for extension in TRANSCODED_EXTENSIONS}
+
+
+def register_transcoder(extension, transcoder):
+    """Kopplar en filändelse (t.ex. '.wav') till en transcoder; None tar bort kopplingen."""
+    if transcoder is None:
+        transcoders.pop(extension.lower(), None)
+    else:
+        transcoders[extension.lower()] = transcoder
+
+
+def transcoder_for(path):
+    transcoder = transcoders.get(os.path.splitext(path)[1].lower())
+    return transcoder if transcoder and transcoder.is_available() else None
+
+
+def served_extension(path):
+    transcoder = transcoder_for(path)
+    return transcoder.output_extension if transcoder else os.path.splitext(path)[1].lower()
+
+
+def content_type_for(path):
+    transcoder = transcoder_for(path)
+    if transcoder: return transcoder.content_type
+    return NATIVE_CONTENT_TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+class TranscodeJob:
+    """En pågående kodning. Utdata skrivs till en .part-fil som läsare följer medan den växer; läsare som
+    registrerat sig med add_listener() anropas (i kodningstråden) varje gång filen växer och när jobbet är klart."""
+    def __init__(self, cache, key, source_path, transcoder):
+        self.cache = cache
+        self.key = key
+        self.source_path = source_path
+        self.transcoder = transcoder
+        self.part_path = cache.entry_path(key, transcoder) + '.part'
+        self.final_path = cache.entry_path(key, transcoder)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self.readers = 0
+        self.finalized = False
+
+    def start(self):
+        # .part-filen skapas innan tråden startar så att läsare alltid kan öppna den
+        out = open(self.part_path, 'wb')
+        threading.Thread(target=self.run, args=(out,), daemon=True, name=f"Transcode-{self.key[:8]}").start()
+
+    def run(self, out):
+        logging.info(f"TRANSCODE: Kodar om {self.source_path} med {self.transcoder.name}")
+        failed = True
+        try:
+            with out:
+                process = self.transcoder.start(self.source_path)
+                while True:
+                    data = process.stdout.read(READ_CHUNK_SIZE)
+                    if not data: break
+                    out.write(data)
+                    out.flush()
+                    with self.lock:
+                        self.size += len(data)
+                    self.notify()
+                failed = process.wait() != 0 or self.size == 0
+        except OSError as e:
+            logging.error(f"TRANSCODE: Kunde inte koda om {self.source_path}: {e}")
+        finally:
+            # Även vid oväntade fel: läsarna får veta att jobbet är slut och väntar inte för evigt
+            with self.lock:
+                self.done = True
+                self.failed = failed
+            self.notify()
+            if failed:
+                logging.warning(f"TRANSCODE: Omkodning av {self.source_path} misslyckades.")
+            self.cache.job_finished(self)
+
+    def progress(self):
+        """Returnerar (storlek, klar, misslyckad)."""
+        with self.lock:
+            return self.size, self.done, self.failed
+
+    def add_listener(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.lock:
+            self.listeners.remove(callback)
+
+    def notify(self):
+        with self.lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback()
+
+    def acquire(self):
+        with self.lock:
+            self.readers += 1
+
+    def release(self):
+        with self.lock:
+            self.readers -= 1
+        self.cache.job_finished(self)
+
+
+class TranscodeCache:
+    """LRU-cache för omkodade filer i directory, begränsad till max_bytes. Nyckeln bygger på källans
+    sökväg, storlek och mtime samt transcoderns namn, så ändrade källfiler kodas om."""
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # slutlig sökväg -> storlek, äldst först
+        self.jobs = {} # nyckel -> TranscodeJob
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path) # Rester från en avbruten körning
+            elif entry.is_file():
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+
+    def key(self, source_path, transcoder):
+        st = os.stat(source_path)
+        raw = f"{os.path.abspath(source_path)}|{st.st_size}|{st.st_mtime_ns}|{transcoder.name}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key, transcoder):
+        return os.path.join(self.directory, key + transcoder.output_extension)
+
+    def open(self, source_path, start=True):
+        """Returnerar ('file', sökväg) för en färdig cachefil eller ('job', TranscodeJob) för en kodning som
+        pågår (eller startas nu). Läsare av ett jobb ska anropa job.release() när de är klara. Med start=False
+        (t.ex. för HEAD) startas ingen kodning; finns ingen färdig fil returneras ('pending', None)."""
+        transcoder = transcoder_for(source_path)
+        key = self.key(source_path, transcoder)
+        final_path = self.entry_path(key, transcoder)
+        with self.lock:
+            if final_path in self.entries:
+                self.entries.move_to_end(final_path)
+                touch = True
+            else:
+                touch = False
+                if not start: return 'pending', None
+                job = self.jobs.get(key)
+                if job is None:
+                    job = TranscodeJob(self, key, source_path, transcoder)
+                    job.start()
+                    self.jobs[key] = job
+                job.acquire()
+        if touch:
+            try:
+                os.utime(final_path) # Spara LRU-ordningen till nästa körning
+            except OSError:
+                pass
+            return 'file', final_path
+        return 'job', job
+
+    def prefetch(self, source_path):
+        """Startar kodning i förväg (t.ex. av nästa spår i kön) om resultatet inte redan finns."""
+        if not transcoder_for(source_path): return
+        try:
+            kind, value = self.open(source_path)
+        except OSError as e:
+            logging.debug("TRANSCODE: Kunde inte förbereda %s: %s", source_path, e)
+            return
+        if kind == 'job': value.release()
+
+    def job_finished(self, job):
+        # Anropas när kodningen är klar och när en läsare släpper jobbet; filen flyttas på plats först när
+        # ingen läser .part-filen (krävs på Windows). Allt sker under self.lock så att open() aldrig ser
+        # ett läge där varken jobbet eller den färdiga filen finns.
+        with self.lock:
+            with job.lock:
+                if not job.done or job.readers > 0 or job.finalized: return
+                job.finalized = True
+            self.jobs.pop(job.key, None)
+            if job.failed:
+                try:
+                    os.remove(job.part_path)
+                except OSError:
+                    pass
+                return
+            os.replace(job.part_path, job.final_path)
+            self.entries[job.final_path] = job.size
+            self.entries.move_to_end(job.final_path)
+        logging.info(f"TRANSCODE: Klar: {job.source_path} ({job.size // 1024} kB)")
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            total = sum(self.entries.values())
+            victims = []
+            while total > self.max_bytes and len(self.entries) > 1:
+                path, size = self.entries.popitem(last=False)
+                victims.append(path)
+                total -= size
+        for path in victims:
+            try:
+                os.remove(path)
+                logging.debug("TRANSCODE: Tog bort %s ur cachen.", path)
+            except OSError:
+                pass